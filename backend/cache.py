@@ -0,0 +1,217 @@
+from typing import Any, Dict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def content_digest(data: bytes) -> str:
+    """
+    Fast content address for raw file bytes
+
+    Parameters
+    ----------
+    data : bytes
+        The raw bytes of the file
+
+    Return
+    ------
+    str
+        A hex BLAKE2b digest of the bytes
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class SQLiteLRUCache:
+    """
+    A persistent key -> JSON value store in SQLite, bounded to max_entries with least recently used eviction.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int = 100_000, ttl: float | None = None) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database file, created along with its folder if missing
+        table : str
+            The table to keep entries in, so several caches can share one database
+        max_entries : int
+            The number of entries kept before the least recently used are evicted
+        ttl : float | None
+            Seconds after which an entry expires, or None to keep entries until evicted
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Any | None:
+        """ Returns the cached value for key, or None on a miss """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """ Stores value under key, evicting the least recently used entries if the cache is full """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """ Hit/miss counters since startup and the current number of entries """
+        with self._lock:
+            entries = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+class HashCache(SQLiteLRUCache):
+    """ Perceptual hashes keyed by the content digest of the image bytes """
+
+    def __init__(self, path: str, max_entries: int = 100_000) -> None:
+        super().__init__(path, table="image_hashes", max_entries=max_entries)
+
+    def get_hashes(self, digest: str) -> Dict[str, str] | None:
+        """
+        Parameters
+        ----------
+        digest : str
+            The content digest of the image, see content_digest
+
+        Return
+        ------
+        Dict[str, str] | None
+            Hex strings of every hash computed for the image keyed by hash name (e.g. 'phash'), or None on a miss
+        """
+        return self.get(digest)
+
+    def set_hashes(self, digest: str, hashes: Dict[str, str]) -> None:
+        """ Stores hashes for an image, merged with any already cached for the same digest """
+        self.set(digest, {**(self.peek(digest) or {}), **hashes})
+
+    def peek(self, digest: str) -> Dict[str, str] | None:
+        """ Reads an entry without touching its recency or the hit counters """
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class GeminiResultCache(SQLiteLRUCache):
+    """ Gemini responses keyed by image content, model name and prompt version """
+
+    def __init__(self, path: str, max_entries: int = 50_000, ttl: float | None = 30 * 24 * 3600) -> None:
+        super().__init__(path, table="gemini_results", max_entries=max_entries, ttl=ttl)
+
+    @staticmethod
+    def make_key(digest: str, model: str, prompt_hash: str) -> str:
+        return f"{digest}:{model}:{prompt_hash}"
+
+    def get_response(self, digest: str, model: str, prompt_hash: str) -> Dict[str, Any] | None:
+        """
+        Parameters
+        ----------
+        digest : str
+            The content digest of the image, see content_digest
+        model : str
+            The Gemini model the response came from
+        prompt_hash : str
+            A hash of the prompt the response was generated with, so prompt changes invalidate old entries
+
+        Return
+        ------
+        Dict[str, Any] | None
+            The cached gemini_response for the image, or None on a miss
+        """
+        return self.get(self.make_key(digest, model, prompt_hash))
+
+    def set_response(self, digest: str, model: str, prompt_hash: str, response: Dict[str, Any]) -> None:
+        self.set(self.make_key(digest, model, prompt_hash), response)
+
+
+class GeminiFileRegistry(SQLiteLRUCache):
+    """
+    Files already uploaded to the Gemini Files API, keyed by the content they were made from,
+    so retries and re-runs can reuse the remote file instead of uploading it again
+    """
+
+    def __init__(self, path: str, max_entries: int = 50_000, expiry_margin: float = 3600) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database file
+        max_entries : int
+            The number of entries kept before the least recently used are evicted
+        expiry_margin : float
+            Seconds before a remote file's expiry that it stops being reused, so it can't expire mid-request
+        """
+        # Remote files live for 48 hours, so nothing older than that is worth keeping
+        super().__init__(path, table="gemini_files", max_entries=max_entries, ttl=48 * 3600)
+        self.expiry_margin = expiry_margin
+
+    def get_file(self, key: str) -> Dict[str, Any] | None:
+        """
+        Return
+        ------
+        Dict[str, Any] | None
+            The serialised File for key, or None if there is none or it is about to expire
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] is not None and entry["expires"] - self.expiry_margin < time.time():
+            self.forget(key)
+            return None
+        return entry["file"]
+
+    def set_file(self, key: str, file: Dict[str, Any], expires: float | None) -> None:
+        """ Registers a serialised File, expires is its remote expiry as a UNIX timestamp """
+        self.set(key, {"file": file, "expires": expires})
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
@@ -0,0 +1,291 @@
+from typing import Any, Dict, List, Set
+import asyncio
+import collections
+import concurrent.futures
+import os
+import threading
+import httpx
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request as HttplibRequest
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from listing import FolderListing
+
+
+DRIVE_FOLDER_MIME = 'application/vnd.google-apps.folder'
+# files.list allows up to 1000 results per page
+DRIVE_PAGE_SIZE = int(os.getenv('DRIVE_PAGE_SIZE', '1000'))
+DRIVE_LIST_WORKERS = int(os.getenv('DRIVE_LIST_WORKERS', '8'))
+# Threads running Drive requests for every session, each keeps its own connection to Google alive
+DRIVE_WORKERS = int(os.getenv('DRIVE_WORKERS', '32'))
+DRIVE_HTTP_TIMEOUT = float(os.getenv('DRIVE_HTTP_TIMEOUT', '60'))
+# Bytes read from Drive and written to the client at a time when passing a download through
+DRIVE_DOWNLOAD_CHUNK_SIZE = int(os.getenv('DRIVE_DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+DRIVE_MEDIA_URL = 'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media'
+# Sibling folders are listed together with "'a' in parents or 'b' in parents ...", this keeps the query short
+DRIVE_PARENTS_PER_QUERY = int(os.getenv('DRIVE_PARENTS_PER_QUERY', '20'))
+
+IMAGE_FIELDS = "nextPageToken, files(id, name, mimeType, modifiedTime, size, thumbnailLink, webViewLink)"
+CHANGE_FIELDS = (
+    "nextPageToken, newStartPageToken, "
+    "changes(fileId, removed, file(id, name, mimeType, parents, trashed, size, thumbnailLink, webViewLink))"
+)
+
+
+_service = None
+_service_lock = threading.Lock()
+_local = threading.local()
+_download_client: httpx.AsyncClient | None = None
+
+drive_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DRIVE_WORKERS, thread_name_prefix="drive")
+
+
+def get_drive_service():
+    """
+    The process-wide Drive v3 service, built once from the discovery document bundled with
+    googleapiclient so no request pays for fetching and parsing it. It holds no credentials,
+    run its requests with execute (or authorized_http) to act as a user
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            # Requests made without authorized_http go out unauthenticated and fail, never as another user
+            document = get_static_doc('drive', 'v3')
+            if document is not None:
+                _service = build_from_document(document, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+            else:
+                _service = build('drive', 'v3', http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT), static_discovery=False)
+        return _service
+
+
+def warm_up() -> None:
+    """ Builds the shared service ahead of the first request, call on startup """
+    get_drive_service()
+
+
+def _thread_http() -> httplib2.Http:
+    if not hasattr(_local, 'http'):
+        _local.http = httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT)
+    return _local.http
+
+
+def authorized_http(credentials: Credentials) -> AuthorizedHttp:
+    """
+    Binds credentials to this thread's connection. httplib2 isn't thread safe, so each thread keeps its own
+    connection and reuses it for every request it runs. Use the result on the calling thread only
+    """
+    return AuthorizedHttp(credentials, http=_thread_http())
+
+
+def execute(request, credentials: Credentials) -> Any:
+    """ Runs a request built from get_drive_service() as the owner of credentials """
+    return request.execute(http=authorized_http(credentials))
+
+
+async def execute_async(request, credentials: Credentials) -> Any:
+    """ execute on the shared Drive threads, keeping the event loop free """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(drive_executor, execute, request, credentials)
+
+
+def get_download_client() -> httpx.AsyncClient:
+    """ The pooled client media downloads stream through, created on first use and closed by close_download_client """
+    global _download_client
+    if _download_client is None:
+        _download_client = httpx.AsyncClient(timeout=httpx.Timeout(DRIVE_HTTP_TIMEOUT), follow_redirects=True)
+    return _download_client
+
+
+async def close_download_client() -> None:
+    global _download_client
+    if _download_client is not None:
+        client, _download_client = _download_client, None
+        await client.aclose()
+
+
+async def open_media_stream(credentials: Credentials, file_id: str, range_header: str | None = None) -> httpx.Response:
+    """
+    Starts downloading a file's content without reading the body, so it can be passed on to the client
+    chunk by chunk in constant memory. The caller must aclose() the response
+
+    Parameters
+    ----------
+    credentials : Credentials
+        The user's credentials, refreshed first if they have expired
+    file_id : str
+        The Drive file to download
+    range_header : str | None
+        The client's Range header, passed on as is so Drive answers 206 with just those bytes
+
+    Return
+    ------
+    httpx.Response
+        Drive's response with the body still unread, its status may be an error
+    """
+    if not credentials.valid:
+        # Refreshing is a blocking token request, so do it on a Drive thread
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(drive_executor, lambda: credentials.refresh(HttplibRequest(_thread_http())))
+    # Raw bytes are passed through, so ask for them unencoded to keep Content-Length and Content-Range exact
+    headers = {'Authorization': f'Bearer {credentials.token}', 'Accept-Encoding': 'identity'}
+    if range_header:
+        headers['Range'] = range_header
+    client = get_download_client()
+    request = client.build_request('GET', DRIVE_MEDIA_URL.format(file_id=file_id), headers=headers)
+    return await client.send(request, stream=True)
+
+
+def image_entry(file: Dict[str, Any]) -> Dict[str, Any]:
+    """ The fields the frontend uses for a Drive image """
+    return {
+        'id': file['id'],
+        'name': file['name'],
+        'mimeType': file.get('mimeType', ''),
+        'url': file.get('webViewLink'),
+        'thumbnailUrl': file.get('thumbnailLink'),
+        'sizeBytes': file.get('size')
+    }
+
+
+def list_folder_images(
+    credentials: Credentials,
+    folder_id: str,
+    workers: int = DRIVE_LIST_WORKERS,
+    folders: Set[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Lists every image under a Drive folder, including subfolders, breadth first. Each level of the tree is
+    fetched with a few multi-parent queries spread over the shared Drive threads, and Drive only returns
+    images and folders so nothing is filtered here. Blocking, run it off the event loop
+
+    Parameters
+    ----------
+    credentials : Credentials
+        The user's credentials
+    folder_id : str
+        The folder to start from
+    workers : int
+        The most list requests in flight at once for this traversal
+    folders : Set[str] | None
+        If given, the ids of folder_id and every subfolder are added to it
+
+    Return
+    ------
+    List[Dict[str, Any]]
+        An image_entry for every image found
+    """
+    service = get_drive_service()
+
+    def list_children(parent_ids: List[str]) -> List[Dict[str, Any]]:
+        http = authorized_http(credentials)
+        parents = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+        query = f"({parents}) and trashed=false and (mimeType='{DRIVE_FOLDER_MIME}' or mimeType contains 'image/')"
+        files = []
+        page_token = None
+        while True:
+            results = service.files().list(
+                q=query,
+                fields=IMAGE_FIELDS,
+                pageToken=page_token,
+                pageSize=DRIVE_PAGE_SIZE
+            ).execute(http=http)
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+
+    if folders is not None:
+        folders.add(folder_id)
+    images = []
+    # Parent groups waiting for one of this traversal's request slots
+    queued = collections.deque([[folder_id]])
+    pending = set()
+    try:
+        while queued or pending:
+            while queued and len(pending) < workers:
+                pending.add(drive_executor.submit(list_children, queued.popleft()))
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                subfolders = []
+                for file in future.result():
+                    if file.get('mimeType') == DRIVE_FOLDER_MIME:
+                        subfolders.append(file['id'])
+                    else:
+                        images.append(image_entry(file))
+                if folders is not None:
+                    folders.update(subfolders)
+                # Start on the next level as soon as its parents are known rather than waiting for the whole level
+                for i in range(0, len(subfolders), DRIVE_PARENTS_PER_QUERY):
+                    queued.append(subfolders[i:i + DRIVE_PARENTS_PER_QUERY])
+    except BaseException:
+        # One failed listing fails the whole traversal, so don't keep listing the rest
+        for future in pending:
+            future.cancel()
+        raise
+    return images
+
+
+def list_folder(credentials: Credentials, folder_id: str) -> FolderListing:
+    """ Lists a folder like list_folder_images, keeping what update_folder_listing needs to bring it up to date later """
+    # Take the token first, so anything changed while crawling is applied by the next update rather than missed
+    token = execute(get_drive_service().changes().getStartPageToken(), credentials)['startPageToken']
+    folders: Set[str] = set()
+    images = list_folder_images(credentials, folder_id, folders=folders)
+    return FolderListing(folder_id, {image['id']: image for image in images}, folders, token)
+
+
+def update_folder_listing(credentials: Credentials, listing: FolderListing) -> FolderListing | None:
+    """
+    Applies the changes made in the user's Drive since listing was taken. A folder nobody touched costs
+    a single changes.list call. Blocking, run it off the event loop
+
+    Parameters
+    ----------
+    credentials : Credentials
+        The user's credentials
+    listing : FolderListing
+        A listing from list_folder or an earlier update, left unchanged
+
+    Return
+    ------
+    FolderListing | None
+        The up to date listing, or None if folders were added to, moved in or removed from the tree,
+        in which case list the folder again
+    """
+    service = get_drive_service()
+    http = authorized_http(credentials)
+    changes = []
+    page_token = listing.token
+    while True:
+        results = service.changes().list(
+            pageToken=page_token,
+            fields=CHANGE_FIELDS,
+            pageSize=DRIVE_PAGE_SIZE,
+            includeRemoved=True
+        ).execute(http=http)
+        changes.extend(results.get('changes', []))
+        if 'newStartPageToken' in results:
+            break
+        page_token = results['nextPageToken']
+
+    images = dict(listing.images)
+    for change in changes:
+        file_id = change['fileId']
+        file = change.get('file') or {}
+        removed = change.get('removed') or not file or file.get('trashed')
+        inside = any(parent in listing.folders for parent in file.get('parents', []))
+        if file.get('mimeType') == DRIVE_FOLDER_MIME or file_id in listing.folders:
+            if file_id == listing.folder_id:
+                if removed:
+                    return None
+            elif file_id in listing.folders and (removed or not inside):
+                return None
+            elif file_id not in listing.folders and inside and not removed:
+                return None
+        elif not removed and inside and file.get('mimeType', '').startswith('image/'):
+            images[file_id] = image_entry(file)
+        else:
+            # Deleted, trashed or moved out of the tree
+            images.pop(file_id, None)
+    return FolderListing(listing.folder_id, images, listing.folders, results['newStartPageToken'], listing.listed_at)
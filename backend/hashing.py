@@ -0,0 +1,115 @@
+from typing import BinaryIO, List
+import asyncio
+import concurrent.futures
+import io
+import os
+from PIL import Image
+import imagehash
+import pillow_heif
+from pillow_heif import register_heif_opener
+
+
+# pHash only looks at a 32x32 greyscale image, so never decode more than a small multiple of that
+HASH_DECODE_SIZE = 64
+
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 1)))
+
+_hash_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def _init_worker() -> None:
+    """ Runs once in each pool process """
+    register_heif_opener()
+
+
+def open_reduced(data: bytes | str | BinaryIO, size: int = HASH_DECODE_SIZE) -> Image.Image:
+    """
+    Decodes an image at the smallest resolution that still covers size x size pixels
+
+    JPEGs are decoded with DCT scaling through Image.draft, and HEIC/HEIF files use their
+    embedded thumbnail when it is large enough. Everything else falls back to a full decode.
+
+    Parameters
+    ----------
+    data : bytes | str | BinaryIO
+        The raw bytes of the image file, its path, or a binary file object. Paths and files are read
+        as the decoder goes, so a JPEG is never held in memory in full
+    size : int
+        The minimum edge length needed by the caller
+
+    Return
+    ------
+    Image.Image
+        A greyscale image, at least size pixels along each edge where the source allows it
+    """
+    source = io.BytesIO(data) if isinstance(data, bytes) else data
+    if pillow_heif.is_supported(source):
+        heif_file = pillow_heif.open_heif(source)
+        primary = heif_file[heif_file.primary_index]
+        for index in range(len(primary.info.get("thumbnails", []))):
+            thumbnail = primary.get_thumbnail(index)
+            if min(thumbnail.size) >= size:
+                return thumbnail.to_pillow().convert("L")
+        return primary.to_pillow().convert("L")
+
+    img = Image.open(source)
+    # Only has an effect for JPEG, where it makes the decoder skip resolution we don't need
+    img.draft("L", (size, size))
+    return img.convert("L")
+
+
+def compute_phash(data: bytes | str | BinaryIO) -> str:
+    """
+    Parameters
+    ----------
+    data : bytes | str | BinaryIO
+        The raw bytes of the image file, its path or a binary file object, see open_reduced
+
+    Return
+    ------
+    str
+        The hex string of the image's perceptual hash
+    """
+    return str(imagehash.phash(open_reduced(data)))
+
+
+def compute_phash_from_path(filepath: str) -> str:
+    """ compute_phash for a file on disk, read inside the worker so the bytes never cross processes """
+    return compute_phash(filepath)
+
+
+def get_hash_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """ The shared process pool for CPU-bound decode work (hashing, pre-upload transcoding), started on first use """
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = concurrent.futures.ProcessPoolExecutor(max_workers=HASH_WORKERS, initializer=_init_worker)
+    return _hash_pool
+
+
+async def compute_phashes(blobs: List[bytes]) -> List[str | BaseException]:
+    """
+    Hashes many images in parallel on the process pool without blocking the event loop
+
+    Parameters
+    ----------
+    blobs : List[bytes]
+        The raw bytes of each image
+
+    Return
+    ------
+    List[str | BaseException]
+        The hex perceptual hash of each image in the same order, or the exception raised while decoding it
+    """
+    return await _run_on_pool(compute_phash, blobs)
+
+
+async def compute_phashes_from_paths(filepaths: List[str]) -> List[str | BaseException]:
+    """ Like compute_phashes, for files already on disk """
+    return await _run_on_pool(compute_phash_from_path, filepaths)
+
+
+async def _run_on_pool(fn, args: list) -> list:
+    loop = asyncio.get_running_loop()
+    pool = get_hash_pool()
+    futures = [loop.run_in_executor(pool, fn, arg) for arg in args]
+    return list(await asyncio.gather(*futures, return_exceptions=True))
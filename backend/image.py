@@ -1,23 +1,273 @@
 from dataclasses import dataclass, field
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Tuple, TypeVar
 from google import genai
 import os
 import json
+import asyncio
 import concurrent.futures
+import collections
+import threading
+import time
 from PIL import Image
 from google.genai.types import File
 from pillow_heif import register_heif_opener
-import subprocess
+import hashlib
+from metadata import save_metadata
+from cache import GeminiFileRegistry, GeminiResultCache, content_digest
+from scheduler import GeminiScheduler, gemini_scheduler
+from preprocess import PREUPLOAD_FORMAT, PREUPLOAD_MAX_EDGE, PREUPLOAD_QUALITY, discard_upload_copy, prepare_for_upload, prepare_for_upload_async
+import math
+
+
+# Gemini bills an image of at most 384px on both edges as 258 tokens, larger images are cropped
+# into 768x768 tiles of 258 tokens each
+IMAGE_TOKENS_PER_TILE = 258
+IMAGE_TILE_SIZE = 768
+IMAGE_SMALL_SIZE = 384
+
+MAX_BATCH_TOKENS = int(os.getenv('MAX_BATCH_TOKENS', '100000'))
+MAX_BATCH_BYTES = int(os.getenv('MAX_BATCH_BYTES', str(100 * 1024 * 1024)))
+MAX_BATCH_IMAGES = int(os.getenv('MAX_BATCH_IMAGES', '50'))
+MAX_CONCURRENT_BATCHES = int(os.getenv('MAX_CONCURRENT_BATCHES', '4'))
+MAX_CONCURRENT_UPLOADS = int(os.getenv('MAX_CONCURRENT_UPLOADS', '16'))
+# Extra requests for images missing from or malformed in a response, each only sends those images
+MAX_FOLLOWUP_REQUESTS = int(os.getenv('MAX_FOLLOWUP_REQUESTS', '2'))
+
+# Header reads are I/O-bound, so use more threads than cores
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', '16'))
+ACCEPTED_FORMATS = ('.heic', '.heif', '.jpeg', '.jpg', '.png')
+
+T = TypeVar('T')
 
 
 @dataclass(slots=True)
 class ImageContainer:
     """ A data container for image data """
     filepath: str
-    img: Image.Image
+    # None for containers made by a lazy loader, see open_image
+    img: Image.Image | None
     exif_dict: Dict[int, Any] | Image.Exif
     gemini_response : Dict[str, Any] = field(default_factory=dict)
+    # Content digest of the file bytes, computed on demand if the loader didn't provide it
+    digest: str | None = None
+    # Bytes actually sent to Gemini after preprocessing, set once the image is uploaded
+    upload_bytes: int | None = None
+
+    # Pixel dimensions read from the file header, for containers that don't hold a decoded image
+    size: Tuple[int, int] | None = None
+
+    def dimensions(self) -> Tuple[int, int]:
+        return self.size if self.size is not None else self.img.size # pyright: ignore - img is set whenever size isn't
+
+    def open_image(self) -> Image.Image:
+        """ Returns the decoded image, decoding it from disk if this container doesn't hold one """
+        if self.img is not None:
+            return self.img
+        img = Image.open(self.filepath)
+        # Load image into memory to release file handle, the result is not kept
+        img.load()
+        return img
+
+    def content_digest(self) -> str:
+        if self.digest is None:
+            with open(self.filepath, "rb") as f:
+                self.digest = content_digest(f.read())
+        return self.digest
+
+
+
+def estimate_image_tokens(image_container: ImageContainer) -> int:
+    """
+    Estimates how many input tokens Gemini will charge for an image
+
+    Parameters
+    ----------
+    image_container: ImageContainer
+        An ImageContainer object for the image
+
+    Return
+    ------
+    int
+        The estimated token cost of the image
+    """
+    width, height = image_container.dimensions()
+    # Images are downscaled before upload, see preprocess.prepare_for_upload
+    if PREUPLOAD_MAX_EDGE > 0 and max(width, height) > PREUPLOAD_MAX_EDGE:
+        scale = PREUPLOAD_MAX_EDGE / max(width, height)
+        width, height = round(width * scale), round(height * scale)
+    if width <= IMAGE_SMALL_SIZE and height <= IMAGE_SMALL_SIZE:
+        return IMAGE_TOKENS_PER_TILE
+    return math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE) * IMAGE_TOKENS_PER_TILE
+
+
+def iter_batches(
+    images: Iterable[ImageContainer],
+    max_tokens: int = MAX_BATCH_TOKENS,
+    max_bytes: int = MAX_BATCH_BYTES,
+    max_images: int = MAX_BATCH_IMAGES,
+) -> Iterator[List[ImageContainer]]:
+    """
+    Greedily packs images, in order, into batches that stay within the token, byte and image count limits.
+    Batches are yielded as soon as they are full, so images can come from a lazy loader
+
+    Parameters
+    ----------
+    images : Iterable[ImageContainer]
+        The images to batch
+    max_tokens : int
+        The most estimated image tokens in one request
+    max_bytes : int
+        The most file bytes in one request
+    max_images : int
+        The most images in one request
+
+    Return
+    ------
+    Iterator[List[ImageContainer]]
+        The batches, an image too large for any limit on its own gets a batch to itself
+    """
+    batch, batch_tokens, batch_bytes = [], 0, 0
+    for img_cont in images:
+        tokens = estimate_image_tokens(img_cont)
+        size = os.path.getsize(img_cont.filepath)
+        if batch and (batch_tokens + tokens > max_tokens or batch_bytes + size > max_bytes or len(batch) >= max_images):
+            yield batch
+            batch, batch_tokens, batch_bytes = [], 0, 0
+        batch.append(img_cont)
+        batch_tokens += tokens
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def make_batches(images: List[ImageContainer], **limits) -> List[List[ImageContainer]]:
+    """ All of iter_batches at once """
+    return list(iter_batches(images, **limits))
+
+
+async def iterate_in_thread(iterable: Iterable[T], maxsize: int = 1) -> AsyncIterator[T]:
+    """
+    Runs a blocking iterable (e.g. a lazy folder scan) on a worker thread and hands its items to the event loop
+    through a bounded queue, so the thread never gets more than maxsize items ahead of the consumer.
+    Errors raised by the iterable are raised here. If the consumer stops early the thread stops too
+
+    Parameters
+    ----------
+    iterable : Iterable[T]
+        The items, produced on the worker thread
+    maxsize : int
+        The most items waiting for the consumer
+
+    Return
+    ------
+    AsyncIterator[T]
+        The items, in order
+    """
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    slots = threading.Semaphore(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def hand_over(item: Any, error: BaseException | None = None) -> None:
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, (item, error))
+        except RuntimeError:
+            # The event loop closed after the consumer went away
+            stop.set()
 
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                hand_over(item)
+        except Exception as e:
+            hand_over(done, e)
+        else:
+            hand_over(done)
+        finally:
+            # Stop a generator here, on the thread it ran on, rather than whenever it is garbage collected
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            slots.release()
+            yield item
+    finally:
+        # Wakes the producer if it is waiting for a slot, it then sees stop and exits
+        stop.set()
+        slots.release()
+
+
+def uniquify_filename(name: str, taken: set, extension: str | None = None) -> str:
+    """
+    Returns name, or name with a numeric suffix, that isn't in taken, and adds it to taken
+
+    Parameters
+    ----------
+    name : str
+        The preferred filename, e.g. 'beach_sunset.jpg'
+    taken : set
+        Filenames already handed out
+    extension : str | None
+        Replaces the extension of name, e.g. '.heic', so the name matches the file it is given to
+
+    Return
+    ------
+    str
+        A filename like 'beach_sunset_2.heic'
+    """
+    stem, ext = os.path.splitext(name)
+    ext = extension if extension is not None else ext
+    candidate, n = f"{stem}{ext}", 2
+    while candidate in taken:
+        candidate, n = f"{stem}_{n}{ext}", n + 1
+    taken.add(candidate)
+    return candidate
+
+
+def fan_out_response(representative: ImageContainer, members: List[ImageContainer], taken: set) -> None:
+    """
+    Copies a representative's gemini_response to the other members of its near-duplicate cluster,
+    giving each a unique filename with its own extension. The representative's own name is made
+    unique as well, so call this for every result, including images with no near-duplicates
+
+    Parameters
+    ----------
+    representative : ImageContainer
+        The image that was sent to Gemini
+    members : List[ImageContainer]
+        The rest of the cluster, may be empty
+    taken : set
+        Filenames already handed out, see uniquify_filename
+    """
+    response = representative.gemini_response
+    if not response or 'name' not in response:
+        return
+    representative.gemini_response = {**response, 'name': uniquify_filename(response['name'], taken)}
+    for member in members:
+        extension = os.path.splitext(member.filepath)[1].lower()
+        member.gemini_response = {**response, 'name': uniquify_filename(response['name'], taken, extension)}
+
+
+# Called with a stage name and the image that just completed it. May be called from worker threads
+ProgressCallback = Callable[[str, ImageContainer], None]
+
+# Only the header was parsed, see DataLoader.iter_images_from_folder_path
+STAGE_READ = "read"
+STAGE_DECODED = "decoded"
+STAGE_UPLOADED = "uploaded"
+STAGE_INFERRED = "inferred"
 
 
 class DataLoader:
@@ -28,38 +278,147 @@ class DataLoader:
         self.objs = objs
         self.images: list[ImageContainer] = []
         self.root = "./images"
-
-    def load_images_from_folder_path(self):
+        # (path, error) for every file or folder skipped during the last scan
+        self.errors: List[Tuple[str, str]] = []
+        # Counts and throughput of the last scan, see _scan
+        self.scan_stats: Dict[str, float] = {}
+
+    def _image_paths(self) -> Iterator[str]:
+        """ Walks folder_path with os.scandir, matching extensions case-insensitively (camera files are often .JPG/.HEIC) """
+        folders = [self.folder_path]
+        while folders:
+            folder = folders.pop()
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif entry.name.lower().endswith(ACCEPTED_FORMATS):
+                            yield entry.path
+            except OSError as e:
+                print(f"Skipping folder {folder}: {e}")
+                self.errors.append((folder, str(e)))
+
+    @staticmethod
+    def _read_image(filepath: str, decode: bool) -> ImageContainer:
+        """ Reads one image, decoding its pixels only if decode is set """
+        if not decode:
+            # Image.open only reads the header, the pixel data is never decoded here
+            with Image.open(filepath) as img:
+                exif_dict = img.getexif()
+                size = img.size
+            return ImageContainer(filepath=filepath, img=None, exif_dict=exif_dict, size=size)
+
+        img = Image.open(filepath)
+        # Load image into memory to release file handle
+        img.load()
+        # HEIF/HEIC files often store EXIF data in a different dictionary key
+        # For robust reading, check both the standard method and the 'exif' key
+        # if img.format in ('HEIF', 'HEIC') and 'exif' in img.info:
+        #     exif_bytes = img.info['exif']
+        #     exif_dict = piexif.load(exif_bytes)
+        # else:
+        # Standard JPEG/PNG/TIFF method
+        # TODO: Unify exif_dict formats
+        exif_dict = img.getexif()
+        return ImageContainer(filepath=filepath, img=img, exif_dict=exif_dict)
+
+    def _scan(
+        self,
+        decode: bool,
+        workers: int,
+        on_progress: ProgressCallback | None,
+        paths: Iterable[str] | None = None,
+    ) -> Iterator[ImageContainer]:
+        """
+        Reads every image in folder_path, or just the image files among paths, on a thread pool, so slow storage
+        (e.g. a NAS) is read in parallel. Results come back in scan order, files that fail to read are recorded
+        in self.errors and skipped
         """
+        self.errors = []
+        start = time.perf_counter()
+        scanned = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # Only a few reads per worker are queued, so a lazy scan never runs far ahead of its consumer
+            window: collections.deque = collections.deque()
+            if paths is None:
+                paths = self._image_paths()
+            else:
+                paths = (path for path in paths if path.lower().endswith(ACCEPTED_FORMATS))
+            while True:
+                for filepath in paths:
+                    window.append((filepath, executor.submit(self._read_image, filepath, decode)))
+                    if len(window) >= workers * 4:
+                        break
+                if not window:
+                    break
+
+                filepath, future = window.popleft()
+                scanned += 1
+                try:
+                    img_cont = future.result()
+                except Exception as e:
+                    print(f"Skipping {filepath}: {e}")
+                    self.errors.append((filepath, str(e)))
+                    continue
+                if on_progress is not None:
+                    on_progress(STAGE_DECODED if decode else STAGE_READ, img_cont)
+                yield img_cont
+
+        elapsed = time.perf_counter() - start
+        self.scan_stats = {
+            "files": scanned,
+            "errors": len(self.errors),
+            "seconds": elapsed,
+            "files_per_sec": scanned / elapsed if elapsed > 0 else 0.0,
+        }
+        print(f"Scanned {scanned} files in {elapsed:.2f}s ({self.scan_stats['files_per_sec']:.1f} files/sec), {len(self.errors)} skipped")
+
+    def load_images_from_folder_path(self, on_progress: ProgressCallback | None = None, workers: int = SCAN_WORKERS):
+        """
+        Parameters
+        ----------
+        on_progress : ProgressCallback | None
+            Called with STAGE_DECODED as each image finishes loading
+        workers : int
+            The number of files read in parallel
+
         Returns
         -------
         List[ImageContainer]
-            A list of ImageContainers containing the Image object and EXIF dictionary associated with every image in the folder_path (including subdirectories)
+            A list of ImageContainers containing the Image object and EXIF dictionary associated with every image in the folder_path (including subdirectories).
+            Files that can't be read are skipped and listed in self.errors
         """
-        accepted_formats = ('heic', 'jpeg', 'jpg', 'png')
-        for root, _, files in os.walk(self.folder_path):
-            for name in files:
-                if name.endswith(accepted_formats):
-                    filepath = os.path.join(root, name)
-                    img = Image.open(filepath)
-                    # Load image into memory to release file handle
-                    img.load()
-                    # HEIF/HEIC files often store EXIF data in a different dictionary key
-                    # For robust reading, check both the standard method and the 'exif' key
-                    # if img.format in ('HEIF', 'HEIC') and 'exif' in img.info:
-                    #     exif_bytes = img.info['exif']
-                    #     exif_dict = piexif.load(exif_bytes)
-                    # else:
-                    # Standard JPEG/PNG/TIFF method
-                    exif_dict = img.getexif()
-                    if exif_dict is None:
-                        # return "No EXIF data found."
-                        return None
-                    # TODO: Unify exif_dict formats
-                    if exif_dict is not None: 
-                        self.images.append(ImageContainer(filepath=filepath, img=img, exif_dict=exif_dict))
+        self.images.extend(self._scan(decode=True, workers=workers, on_progress=on_progress))
         return self.images
 
+    def iter_images_from_folder_path(
+        self,
+        on_progress: ProgressCallback | None = None,
+        workers: int = SCAN_WORKERS,
+        paths: Iterable[str] | None = None,
+    ) -> Iterator[ImageContainer]:
+        """
+        Lazy version of load_images_from_folder_path: only file headers are parsed and no decoded image is kept,
+        so memory doesn't grow with the size of the folder. Use ImageContainer.open_image for the pixels
+
+        Parameters
+        ----------
+        on_progress : ProgressCallback | None
+            Called with STAGE_READ as each image's header is read
+        workers : int
+            The number of headers read in parallel
+        paths : Iterable[str] | None
+            Only read these files instead of walking folder_path, e.g. the ones an upload finished saving
+
+        Returns
+        -------
+        Iterator[ImageContainer]
+            ImageContainers holding the path, header dimensions and EXIF data of every image in the folder_path (including subdirectories)
+        """
+        return self._scan(decode=False, workers=workers, on_progress=on_progress, paths=paths)
+
     def load_images_from_obj(self):
         """
         Returns
@@ -89,13 +448,171 @@ class DataLoader:
 class ImageProcessor:
     """ A class for managing image processing functions """
 
-    def __init__(self) -> None:
+    MODEL = "gemini-2.5-flash"
+    PROMPT = "Each photo is preceded by its id. For each photo generate 3 one word tags, a short description sentence, and a filename consisting of 2 words in snake case (for example this_photo.jpg) followed by the file extension. Please return the results as a JSON array with one object per photo, with the fields 'id' for the photo's id, 'name' for the filename, 'tags' for the tags, and 'description' for the description. If two pictures are the same, still include JSON data for each of them, do not just omit it."
+    # Changing the prompt changes this hash, which invalidates cached results made with the old prompt
+    PROMPT_HASH = hashlib.sha256(PROMPT.encode()).hexdigest()[:16]
+
+    def __init__(
+        self,
+        result_cache: GeminiResultCache | None = None,
+        file_registry: GeminiFileRegistry | None = None,
+        scheduler: GeminiScheduler = gemini_scheduler,
+    ) -> None:
         # Register the opener once at the start of your application
         register_heif_opener()
 
         # Start the Gemini client
         self.client = genai.Client()
 
+        # Previous Gemini responses, so identical images are never uploaded or inferred twice
+        self.result_cache = result_cache
+
+        # Files still live on the Gemini Files API, so retries and re-runs skip the upload
+        self.file_registry = file_registry
+
+        # Rate limits, retries and the upload threads, shared with every other processor in the process
+        self.scheduler = scheduler
+
+        # Bounds concurrent uploads on the async path, like the thread pool does on the sync path
+        self._upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+    def _registry_key(self, img_cont: ImageContainer) -> str:
+        # The uploaded bytes depend on the preprocessing settings as well as the original content
+        return f"{img_cont.content_digest()}:{PREUPLOAD_MAX_EDGE}:{PREUPLOAD_FORMAT}:{PREUPLOAD_QUALITY}"
+
+    def _reuse_upload(self, img_cont: ImageContainer) -> File | None:
+        """ Returns a still valid remote File previously uploaded for this image, if there is one """
+        if self.file_registry is None:
+            return None
+        entry = self.file_registry.get_file(self._registry_key(img_cont))
+        if entry is None:
+            return None
+        print(f"Reusing uploaded file {entry.get('name')} for {img_cont.filepath}")
+        img_cont.upload_bytes = 0
+        return File.model_validate(entry)
+
+    def _register_upload(self, img_cont: ImageContainer, uploaded_file: File) -> None:
+        if self.file_registry is None:
+            return
+        expires = uploaded_file.expiration_time.timestamp() if uploaded_file.expiration_time else None
+        self.file_registry.set_file(self._registry_key(img_cont), uploaded_file.model_dump(mode="json"), expires)
+
+    def _forget_uploads(self, images: List[ImageContainer]) -> None:
+        """ Drops registry entries after a failed request, in case a remote file was deleted early """
+        if self.file_registry is None:
+            return
+        for img_cont in images:
+            self.file_registry.forget(self._registry_key(img_cont))
+
+    def _lookup_cached(self, images: List[ImageContainer]) -> List[ImageContainer]:
+        """
+        Fills in gemini_response for every image found in the result cache
+
+        Return
+        ------
+        List[ImageContainer]
+            The images that still need to go to Gemini
+        """
+        if self.result_cache is None:
+            return images
+        misses = []
+        for img_cont in images:
+            cached = self.result_cache.get_response(img_cont.content_digest(), self.MODEL, self.PROMPT_HASH)
+            if cached is not None:
+                img_cont.gemini_response = cached
+            else:
+                misses.append(img_cont)
+        print(f"Gemini result cache: {len(images) - len(misses)} hits, {len(misses)} misses")
+        return misses
+
+    def _request(self, pending: Dict[str, Tuple[ImageContainer, File]]) -> Dict[str, Any]:
+        """ The generate_content arguments asking for a result for each pending image, keyed by its id """
+        contents: List[Any] = []
+        for image_id, (_, uploaded_file) in pending.items():
+            contents.append(f"id: {image_id}")
+            contents.append(uploaded_file)
+        contents.append(self.PROMPT)
+        return {
+            "model": self.MODEL,
+            "contents": contents,
+            "config": {
+                "response_mime_type": "application/json",
+                # Results are matched to images by id, so a dropped or reordered item can't shift the others
+                "response_schema": {
+                    "type": "ARRAY",
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "id": {"type": "STRING", "enum": list(pending)},
+                            "name": {"type": "STRING"},
+                            "tags": {"type": "ARRAY", "items": {"type": "STRING"}},
+                            "description": {"type": "STRING"},
+                        },
+                        "required": ["id", "name", "tags", "description"],
+                        "property_ordering": ["id", "name", "tags", "description"],
+                    },
+                },
+            },
+        }
+
+    def _apply_response(
+        self,
+        pending: Dict[str, Tuple[ImageContainer, File]],
+        response_text: str | None,
+        on_progress: ProgressCallback | None = None,
+    ) -> Dict[str, Tuple[ImageContainer, File]]:
+        """
+        Parses Gemini's JSON reply and assigns each valid result to the image with its id
+
+        Parameters
+        ----------
+        pending : Dict[str, Tuple[ImageContainer, File]]
+            The images that were sent to Gemini and their uploaded files, keyed by the id they were sent with
+        response_text : str | None
+            The text of Gemini's response
+        on_progress : ProgressCallback | None
+            Called with STAGE_INFERRED for each image that got a result
+
+        Return
+        ------
+        Dict[str, Tuple[ImageContainer, File]]
+            The entries of pending that are still missing a result, because Gemini left them out or returned something malformed
+        """
+        print(response_text)
+        try:
+            results = json.loads(response_text) # pyright: ignore - pure nonsense error
+        except (json.JSONDecodeError, TypeError) as e:
+            print(f"Error parsing JSON: {e}")
+            return pending
+        if not isinstance(results, list):
+            print("Error parsing JSON: expected a list of results")
+            return pending
+
+        missing = dict(pending)
+        for result in results:
+            if not isinstance(result, dict) or result.get('id') not in missing:
+                continue
+            resp = {
+                'name': result.get('name'),
+                'tags': result.get('tags'),
+                'description': result.get('description'),
+            }
+            if not (
+                isinstance(resp['name'], str) and resp['name']
+                and isinstance(resp['tags'], list) and all(isinstance(tag, str) for tag in resp['tags'])
+                and isinstance(resp['description'], str)
+            ):
+                continue
+            # Assign gemini data to each image container object for use later
+            img_cont, _ = missing.pop(result['id'])
+            img_cont.gemini_response = resp
+            if self.result_cache is not None:
+                self.result_cache.set_response(img_cont.content_digest(), self.MODEL, self.PROMPT_HASH, resp)
+            if on_progress is not None:
+                on_progress(STAGE_INFERRED, img_cont)
+        return missing
+
     def gemini_inference(self, images: List[ImageContainer]) -> List[ImageContainer]|None:
         """
         Uploads all images to Gemini, and then performs inference on them in one big batch
@@ -108,8 +625,13 @@ class ImageProcessor:
         Return
         ------
         List[ImageContainer] | None
-            The same list of ImageContainer objects, but with updated gemini_response fields, or None if Gemini fails
+            The same list of ImageContainer objects, but with updated gemini_response fields. Images Gemini
+            still has no valid result for after MAX_FOLLOWUP_REQUESTS follow-ups keep an empty gemini_response
         """
+        # Serve what we can from the result cache, only the misses go to Gemini
+        misses = self._lookup_cached(images)
+        if not misses:
+            return images
 
         def upload_single_file(img_cont: ImageContainer) -> File|None:
             """
@@ -126,45 +648,241 @@ class ImageProcessor:
                 A File object for the uploaded image, or None if uploading fails
             """
             filepath = img_cont.filepath
+            reused = self._reuse_upload(img_cont)
+            if reused is not None:
+                return reused
             print(f"Uploading {filepath}...")
+            upload_path = filepath
             try:
-                uploaded_file = self.client.files.upload(file=filepath)
-                print(f"Successfully uploaded: {uploaded_file.name}")
+                # Send a downscaled copy, the original is kept for writing metadata
+                upload_path, img_cont.upload_bytes = prepare_for_upload(filepath)
+                uploaded_file = self.scheduler.call(self.client.files.upload, file=upload_path)
+                print(f"Successfully uploaded: {uploaded_file.name} ({img_cont.upload_bytes} bytes)")
+                self._register_upload(img_cont, uploaded_file)
                 return uploaded_file
             except Exception as e:
                 print(f"Error uploading {filepath}: {e}")
                 return None
+            finally:
+                discard_upload_copy(filepath, upload_path)
 
 
-        # Use ThreadPoolExecutor to run tasks concurrently
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            uploaded_images = executor.map(upload_single_file, images)
+        # Upload concurrently on the scheduler's persistent threads
+        uploaded_images = list(self.scheduler.executor.map(upload_single_file, misses))
         
-        # Filter out any failed uploads
+        # Filter out any failed uploads, keeping the images that were sent in step with their files
+        sent = [img_cont for img_cont, f in zip(misses, uploaded_images) if f is not None]
         uploaded_images = [f for f in uploaded_images if f is not None]
 
-        # Send prompt
-        prompt = "Generate 3 one word tags, a short description sentence, and a filename consisting of 2 words in snake case (for example this_photo.jpg) followed by the file extension for each photo passed. Please return the results for each photo in JSON format with the fields 'name' for the filename 'tags' for the tags, and 'description' for the description. Output the analysis as a single JSON object. DO NOT include any markdown ```json tags. If two pictures are the same, still include JSON data for them, do not just omit it."
-        contents = [image for image in uploaded_images]
-        contents.append(prompt) # pyright: ignore - pure nonsense error
-        response = self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=contents, # pyright: ignore - pure nonsense error
-            config={
-                "response_mime_type": "application/json", 
-            },
-        )
-        try:
-            # response.text is guaranteed to be valid JSON due to the config
-            print(response.text)
-            resp_dict = json.loads(response.text) # pyright: ignore - pure nonsense error
-            # Assign gemini data to each image container object for use later
-            for i, resp in enumerate(resp_dict):
-                images[i].gemini_response = resp
+        # Send prompt, then ask again for only the images that came back missing or malformed
+        pending = {f"img{i}": (img_cont, f) for i, (img_cont, f) in enumerate(zip(sent, uploaded_images))}
+        if not pending:
+            # Every upload failed, there is nothing to ask about
             return images
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON: {e}")
-            return None
+        for attempt in range(1 + MAX_FOLLOWUP_REQUESTS):
+            try:
+                response = self.scheduler.call(self.client.models.generate_content, **self._request(pending))
+            except Exception as e:
+                if attempt == 0:
+                    self._forget_uploads(sent)
+                    raise
+                print(f"Follow-up request failed: {e}")
+                break
+            pending = self._apply_response(pending, response.text)
+            if not pending:
+                break
+            print(f"No valid result for {len(pending)} images, asking Gemini again for just those")
+        return images
+
+    async def gemini_inference_async(
+        self,
+        images: List[ImageContainer],
+        on_progress: ProgressCallback | None = None,
+    ) -> List[ImageContainer]|None:
+        """
+        Async version of gemini_inference using the client's aio interface, so the event loop is never blocked
+
+        Parameters
+        ----------
+        images : List[ImageContainer]
+            A list of ImageContainer objects for each image you want to perform inference on
+        on_progress : ProgressCallback | None
+            Called with STAGE_UPLOADED and STAGE_INFERRED as each image completes those stages,
+            cache hits go straight to STAGE_INFERRED
+
+        Return
+        ------
+        List[ImageContainer] | None
+            The same list of ImageContainer objects, but with updated gemini_response fields, see gemini_inference
+        """
+        # The cache and digest reads touch the disk, so run them off the event loop
+        misses = await asyncio.to_thread(self._lookup_cached, images)
+        if on_progress is not None:
+            pending = {id(img_cont) for img_cont in misses}
+            for img_cont in images:
+                if id(img_cont) not in pending:
+                    on_progress(STAGE_INFERRED, img_cont)
+        if not misses:
+            return images
+
+        async def upload_single_file(img_cont: ImageContainer) -> File|None:
+            """ Uploads a single file and returns the uploaded File object, or None if uploading fails """
+            filepath = img_cont.filepath
+            reused = await asyncio.to_thread(self._reuse_upload, img_cont)
+            if reused is not None:
+                if on_progress is not None:
+                    on_progress(STAGE_UPLOADED, img_cont)
+                return reused
+            async with self._upload_slots:
+                print(f"Uploading {filepath}...")
+                upload_path = filepath
+                try:
+                    # Downscale and re-encode on the process pool, the original is kept for writing metadata
+                    upload_path, img_cont.upload_bytes = await prepare_for_upload_async(filepath)
+                    uploaded_file = await self.scheduler.call_async(self.client.aio.files.upload, file=upload_path)
+                    print(f"Successfully uploaded: {uploaded_file.name} ({img_cont.upload_bytes} bytes)")
+                    await asyncio.to_thread(self._register_upload, img_cont, uploaded_file)
+                    if on_progress is not None:
+                        on_progress(STAGE_UPLOADED, img_cont)
+                    return uploaded_file
+                except Exception as e:
+                    print(f"Error uploading {filepath}: {e}")
+                    return None
+                finally:
+                    discard_upload_copy(filepath, upload_path)
+
+        uploaded_images = await asyncio.gather(*(upload_single_file(img_cont) for img_cont in misses))
+
+        # Filter out any failed uploads, keeping the images that were sent in step with their files
+        sent = [img_cont for img_cont, f in zip(misses, uploaded_images) if f is not None]
+        uploaded_images = [f for f in uploaded_images if f is not None]
+
+        # Send prompt, then ask again for only the images that came back missing or malformed
+        pending = {f"img{i}": (img_cont, f) for i, (img_cont, f) in enumerate(zip(sent, uploaded_images))}
+        if not pending:
+            # Every upload failed, there is nothing to ask about
+            return images
+        for attempt in range(1 + MAX_FOLLOWUP_REQUESTS):
+            try:
+                response = await self.scheduler.call_async(self.client.aio.models.generate_content, **self._request(pending))
+            except Exception as e:
+                if attempt == 0:
+                    await asyncio.to_thread(self._forget_uploads, sent)
+                    raise
+                print(f"Follow-up request failed: {e}")
+                break
+            pending = await asyncio.to_thread(self._apply_response, pending, response.text, on_progress)
+            if not pending:
+                break
+            print(f"No valid result for {len(pending)} images, asking Gemini again for just those")
+        return images
+
+    def gemini_inference_batched(
+        self,
+        images: Iterable[ImageContainer],
+        max_concurrent: int = MAX_CONCURRENT_BATCHES,
+    ) -> Iterator[Tuple[List[ImageContainer], List[ImageContainer] | None]]:
+        """
+        Splits images into size- and token-bounded batches (see iter_batches) and runs several at once,
+        yielding each batch as soon as its inference finishes. images may be a lazy iterator, at most
+        max_concurrent batches are read ahead of the results
+
+        Parameters
+        ----------
+        images : Iterable[ImageContainer]
+            ImageContainer objects for each image you want to perform inference on
+        max_concurrent : int
+            The most batches in flight at the same time
+
+        Return
+        ------
+        Iterator[Tuple[List[ImageContainer], List[ImageContainer] | None]]
+            Pairs of a batch and its gemini_inference result (None if Gemini failed), in completion order
+        """
+        def finished(future: concurrent.futures.Future, batch: List[ImageContainer]):
+            try:
+                return batch, future.result()
+            except Exception as e:
+                print(f"Error during batch inference: {e}")
+                return batch, None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            pending: Dict[concurrent.futures.Future, List[ImageContainer]] = {}
+            for batch in iter_batches(images):
+                # Wait for a free slot before reading more images
+                if len(pending) >= max_concurrent:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield finished(future, pending.pop(future))
+                pending[executor.submit(self.gemini_inference, batch)] = batch
+            for future in concurrent.futures.as_completed(pending):
+                yield finished(future, pending[future])
+
+    async def gemini_inference_batched_async(
+        self,
+        images: Iterable[ImageContainer],
+        max_concurrent: int = MAX_CONCURRENT_BATCHES,
+        on_progress: ProgressCallback | None = None,
+    ) -> AsyncIterator[Tuple[List[ImageContainer], List[ImageContainer] | None]]:
+        """
+        Async version of gemini_inference_batched, batches run as concurrent tasks on the event loop.
+        images may be a lazy, blocking iterator (e.g. iter_images_from_folder_path): it is read and batched on a
+        worker thread, and the first batches are sent while the rest of the folder is still being read
+
+        Parameters
+        ----------
+        images : Iterable[ImageContainer]
+            ImageContainer objects for each image you want to perform inference on
+        max_concurrent : int
+            The most batches in flight at the same time
+        on_progress : ProgressCallback | None
+            Passed on to gemini_inference_async for every batch
+
+        Return
+        ------
+        AsyncIterator[Tuple[List[ImageContainer], List[ImageContainer] | None]]
+            Pairs of a batch and its gemini_inference_async result (None if Gemini failed), in completion order
+        """
+        batch_slots = asyncio.Semaphore(max_concurrent)
+        # Finished batches, then None once every batch is done, or the error that stopped the batching
+        finished: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def run_batch(batch: List[ImageContainer]) -> None:
+            try:
+                result = batch, await self.gemini_inference_async(batch, on_progress)
+            except Exception as e:
+                print(f"Error during batch inference: {e}")
+                result = batch, None
+            finally:
+                batch_slots.release()
+            await finished.put(result)
+
+        async def submit_batches() -> None:
+            try:
+                image_count = 0
+                async for batch in iterate_in_thread(iter_batches(images)):
+                    # Wait for a free slot before reading more images
+                    await batch_slots.acquire()
+                    image_count += len(batch)
+                    tasks.append(asyncio.create_task(run_batch(batch)))
+                print(f"Split {image_count} images into {len(tasks)} batches")
+                await asyncio.gather(*tasks)
+                await finished.put(None)
+            except Exception as e:
+                await finished.put(e)
+
+        submitter = asyncio.create_task(submit_batches())
+        try:
+            while (result := await finished.get()) is not None:
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            # Stop reading and outstanding batches if the consumer goes away, e.g. the client disconnects
+            submitter.cancel()
+            for task in tasks:
+                task.cancel()
 
     def save_updated_image(self, image_container: ImageContainer) -> Dict[str, str] | None:
         """
@@ -175,53 +893,46 @@ class ImageProcessor:
         image_container: ImageContainer
             An ImageContainer object for the image to update
         """
-        folderpath = os.path.split(image_container.filepath)[0]
-        new_filepath = folderpath + '/' + image_container.gemini_response['name']
-
-        # Now update the EXIF, XMP, and IPTC metadata 
-        tag_string = ", ".join(image_container.gemini_response['tags'])
-        # -sep ',': Sets the separator for keywords to a comma
-        # -XMP:Subject+=: add to the list without overwriting existing tags
-        # -overwrite_original: Saves changes directly to the original file
-        command_list = [
-            'exiftool', 
-            '-sep', ',', 
-            f'-EXIF:ImageDescription={image_container.gemini_response["description"]}',
-            f'-XMP:Subject+={tag_string}', 
-            f'-IPTC:Keywords+={tag_string}', # Also add to IPTC for maximum compatibility
-            f'-filename={new_filepath}', 
-            image_container.filepath
-        ]
+        return self.save_updated_images([image_container])[0]
 
-        try:
-            subprocess.run(command_list, check=True, capture_output=True, text=True)
+    def save_updated_images(self, image_containers: List[ImageContainer]) -> List[Dict[str, str] | None]:
+        """
+        Updates the metadata and file names of many images, in Python for JPEG/PNG and in one round trip to the shared exiftool workers otherwise
 
-            # Return name and metadata of image for UI
-            return image_container.gemini_response
-        except subprocess.CalledProcessError as e:
-            print(f"Error during XMP write: {e.stderr}")
-            return None
-        except FileNotFoundError:
-            print("Error: ExifTool not found.")
-            return None
+        Parameters
+        ----------
+        image_containers: List[ImageContainer]
+            The images to update, each with a gemini_response
 
+        Returns
+        -------
+        List[Dict[str, str] | None]
+            The gemini_response of each image for the UI, or None where the write failed
+        """
+        # Now update the EXIF, XMP, and IPTC metadata
+        results = save_metadata([(img.filepath, img.gemini_response) for img in image_containers])
+
+        saved = []
+        for img, (ok, output) in zip(image_containers, results):
+            if ok:
+                # Return name and metadata of image for UI
+                saved.append(img.gemini_response)
+            else:
+                print(f"Error during XMP write for {img.filepath}: {output.strip()}")
+                saved.append(None)
+        return saved
 
 def main():
     image_folder = "/home/alexander/Pictures/"
     processor = ImageProcessor()
-    images = DataLoader(folder_path=image_folder, objs="").load_images_from_folder_path()
-    if images is not None:
-        # Split images into batches, send 50 at a time
-        def split(a, n):
-            k, m = divmod(len(a), n)
-            return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
-        batches = split(images, 50)
-        for batch in batches:
-            batch = processor.gemini_inference(batch)
-            if batch is not None:
-                for img in batch:
-                    print(f"Original name: {img.filepath}\nNew name: {img.gemini_response['name']}, tags: {img.gemini_response['tags']}, desc: {img.gemini_response['description']}")
-                    processor.save_updated_image(img)
+    # Lazy loading keeps memory flat however large the folder is
+    images = DataLoader(folder_path=image_folder, objs="").iter_images_from_folder_path()
+    for _, batch in processor.gemini_inference_batched(images):
+        if batch is not None:
+            batch = [img for img in batch if img.gemini_response]
+            for img in batch:
+                print(f"Original name: {img.filepath}\nNew name: {img.gemini_response['name']}, tags: {img.gemini_response['tags']}, desc: {img.gemini_response['description']}")
+            processor.save_updated_images(batch)
 
 
 if __name__ == "__main__":
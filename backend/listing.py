@@ -0,0 +1,55 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Set
+import collections
+import os
+import time
+
+
+# Thumbnail links in a listing expire after a while, so listings older than this are crawled again
+LISTING_MAX_AGE = float(os.getenv('LISTING_MAX_AGE', '3600'))
+# Folders a session keeps listings for, least recently used are dropped first
+MAX_LISTINGS_PER_SESSION = int(os.getenv('MAX_LISTINGS_PER_SESSION', '8'))
+
+
+@dataclass(slots=True)
+class FolderListing:
+    """
+    Every image under a cloud folder as of a change token, a Drive changes page token or a OneDrive
+    delta link. Kept per session so the next listing only has to apply what changed since the token
+    """
+    folder_id: str
+    # image id -> the entry returned to the frontend
+    images: Dict[str, Dict[str, Any]]
+    # The folder and all its subfolders, to tell whether a changed item is inside the tree
+    folders: Set[str]
+    token: str
+    listed_at: float = field(default_factory=time.monotonic)
+
+    def expired(self) -> bool:
+        return time.monotonic() - self.listed_at > LISTING_MAX_AGE
+
+    def files(self) -> List[Dict[str, Any]]:
+        return list(self.images.values())
+
+
+class ListingCache:
+    """ A session's most recently used folder listings """
+
+    def __init__(self, max_entries: int = MAX_LISTINGS_PER_SESSION) -> None:
+        self.max_entries = max_entries
+        self._listings: collections.OrderedDict[str, FolderListing] = collections.OrderedDict()
+
+    def get(self, folder_id: str) -> FolderListing | None:
+        """ The folder's listing, or None if there is none or it has expired """
+        listing = self._listings.get(folder_id)
+        if listing is None or listing.expired():
+            self._listings.pop(folder_id, None)
+            return None
+        self._listings.move_to_end(folder_id)
+        return listing
+
+    def put(self, listing: FolderListing) -> None:
+        self._listings[listing.folder_id] = listing
+        self._listings.move_to_end(listing.folder_id)
+        while len(self._listings) > self.max_entries:
+            self._listings.popitem(last=False)
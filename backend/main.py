@@ -1,39 +1,62 @@
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File
-from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
+from fastapi.responses import RedirectResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import os
 from pathlib import Path
 import secrets
-from typing import Dict, List
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Tuple
 from PIL import Image
 import imagehash
 from collections import defaultdict
 import json
-import io
 import msal
 import httpx
 import shutil
+import asyncio
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
+from grouping import GROUPING_BACKENDS, group_similar, hash_to_int
+from cache import GeminiFileRegistry, GeminiResultCache, HashCache
+from hashing import compute_phashes_from_paths
+from uploads import save_stream, save_upload
+from scheduler import gemini_scheduler
+import onedrive
+from onedrive import ONEDRIVE_DOWNLOAD_CHUNK_SIZE, GraphError, close_graph_client, get_item, open_download_stream
+import drive
+from drive import DRIVE_DOWNLOAD_CHUNK_SIZE, close_download_client, execute_async, get_drive_service, open_media_stream, warm_up
+from listing import FolderListing, ListingCache
 
 try:
-    from image import ImageProcessor, DataLoader, ImageContainer
+    from image import ImageProcessor, DataLoader, ImageContainer, STAGE_INFERRED, STAGE_UPLOADED, fan_out_response
 except ImportError:
     print("Error: 'image.py' not found. Please ensure it's in the same directory.")
     # Define dummy classes to allow the server to start, but upload will fail
     class ImageProcessor: pass
     class DataLoader: pass
     class ImageContainer: pass
+    STAGE_INFERRED = "inferred"
+    STAGE_UPLOADED = "uploaded"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the shared Drive service before the first request needs it
+    await asyncio.to_thread(warm_up)
+    yield
+    await close_download_client()
+    await close_graph_client()
 
 # Create FastAPI instance
 app = FastAPI(
     title="Google Drive API Server",
     description="FastAPI server with Google Drive OAuth integration and Picker API support",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 origins = [
@@ -51,8 +74,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+CACHE_DIR = Path(os.getenv('AEGIS_CACHE_DIR', Path(__file__).parent / "cache"))
+HASH_CACHE_MAX_ENTRIES = int(os.getenv('HASH_CACHE_MAX_ENTRIES', '100000'))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '50000'))
+GEMINI_CACHE_TTL = float(os.getenv('GEMINI_CACHE_TTL', str(30 * 24 * 3600)))
+# Files downloaded at once by a cloud import
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', '8'))
+
+hash_cache = HashCache(str(CACHE_DIR / "hashes.sqlite3"), max_entries=HASH_CACHE_MAX_ENTRIES)
+gemini_cache = GeminiResultCache(
+    str(CACHE_DIR / "gemini.sqlite3"),
+    max_entries=GEMINI_CACHE_MAX_ENTRIES,
+    ttl=GEMINI_CACHE_TTL
+)
+gemini_files = GeminiFileRegistry(str(CACHE_DIR / "gemini.sqlite3"))
+
 try:
-    processor = ImageProcessor()
+    processor = ImageProcessor(result_cache=gemini_cache, file_registry=gemini_files)
 except Exception as e:
     print(f"Failed to initialise ImageProcessor: {e}")
     print("Gemini features will not work.")
@@ -317,14 +355,14 @@ async def list_drive_files(request: Request, max_results: int = 10):
     try:
         credentials = get_credentials_from_session(session_id)
         
-        # Build Drive service
-        service = build('drive', 'v3', credentials=credentials, static_discovery=False)
+        # Shared Drive service, the session's credentials are bound per request
+        service = get_drive_service()
         
         # List files
-        results = service.files().list(
+        results = await execute_async(service.files().list(
             pageSize=max_results,
             fields="nextPageToken, files(id, name, mimeType, modifiedTime, size, webViewLink)"
-        ).execute()
+        ), credentials)
         
         items = results.get('files', [])
         
@@ -345,62 +383,126 @@ async def list_drive_files(request: Request, max_results: int = 10):
 
 SIMILARITY_THRESHOLD =20 # Adjust as needed
 
+def store_phashes(phashes: Dict[str, str]):
+    """Cache newly computed pHashes keyed by content digest. Blocking SQLite writes, run it off the event loop"""
+    for digest, phash in phashes.items():
+        hash_cache.set_hashes(digest, {'phash': phash})
+
 @app.post("/api/compute/phash-group")
-async def compute_phash_group(images: List[UploadFile] = File(...)):
+async def compute_phash_group(images: List[UploadFile] = File(...), backend: str = "numpy"):
     """
     Compute pHashes for uploaded images and group visually similar images.
     Only returns groups with more than one image.
+    The backend query parameter selects the grouping engine: 'bktree', 'mih' or 'numpy'.
     """
+    if backend not in GROUPING_BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Unknown grouping backend: {backend}")
+
     phash_dict = {}
+    cache_hits = 0
+    to_hash = {}
 
-    # Compute pHash for each image
-    for img_file in images:
-        try:
-            contents = await img_file.read()
-            image = Image.open(io.BytesIO(contents))
-            phash_dict[img_file.filename] = imagehash.phash(image)
-        except Exception as e:
+    # Uploads are streamed to disk and hashed from there, so no image is held in memory in full
+    temp_dir = Path("./temp_uploads") / secrets.token_hex(8)
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        uploads = []
+        for i, img_file in enumerate(images):
+            file_path = temp_dir / str(i)
+            digest, _ = await save_upload(img_file, file_path)
+            uploads.append((img_file.filename, digest, str(file_path)))
+        
+        # Look up each image by content, only images we haven't hashed before need decoding.
+        # SQLite calls block, so every lookup is made in one go off the event loop
+        cached_hashes = await asyncio.to_thread(lambda: [hash_cache.get_hashes(digest) for _, digest, _ in uploads])
+        for (filename, digest, file_path), cached in zip(uploads, cached_hashes):
+            if cached and 'phash' in cached:
+                phash_dict[filename] = imagehash.hex_to_hash(cached['phash'])
+                cache_hits += 1
+            else:
+                # Keep the upload order so the groups come back in the same order as before
+                phash_dict[filename] = None
+                to_hash[filename] = (digest, file_path)
+
+        # Decode at reduced resolution and hash in parallel on the process pool
+        results = await compute_phashes_from_paths([file_path for _, file_path in to_hash.values()])
+    finally:
+        await asyncio.to_thread(shutil.rmtree, temp_dir, True)
+    
+    new_hashes = {}
+    for (filename, (digest, _)), result in zip(to_hash.items(), results):
+        if isinstance(result, BaseException):
             raise HTTPException(
-                status_code=400, detail=f"Error processing {img_file.filename}: {str(e)}"
+                status_code=400, detail=f"Error processing {filename}: {str(result)}"
             )
+        phash_dict[filename] = imagehash.hex_to_hash(result)
+        new_hashes[digest] = result
+    await asyncio.to_thread(store_phashes, new_hashes)
 
-    # Create adjacency list for similar images
-    adjacency = {fname: set() for fname in phash_dict.keys()}
+    # Find connected components (groups) of images within the similarity threshold
     filenames = list(phash_dict.keys())
-
-    for i, file1 in enumerate(filenames):
-        for j in range(i + 1, len(filenames)):
-            file2 = filenames[j]
-            if phash_dict[file1] - phash_dict[file2] <= SIMILARITY_THRESHOLD:
-                adjacency[file1].add(file2)
-                adjacency[file2].add(file1)
-
-    # Find connected components (groups)
-    visited = set()
-    groups = []
-
-    def dfs(node, group):
-        visited.add(node)
-        group.append(node)
-        for neighbor in adjacency[node]:
-            if neighbor not in visited:
-                dfs(neighbor, group)
-
-    for fname in filenames:
-        if fname not in visited:
-            group = []
-            dfs(fname, group)
-            # Only keep groups with more than 1 image
-            if len(group) > 1:
-                groups.append(group)
+    hashes = [hash_to_int(phash_dict[fname]) for fname in filenames]
+    groups = [
+        [filenames[i] for i in group]
+        for group in group_similar(hashes, SIMILARITY_THRESHOLD, backend=backend)
+    ]
 
     # Convert phash to string for response
     phash_str = {fname: str(hash_val) for fname, hash_val in phash_dict.items()}
 
-    return {"success": True, "phash": phash_str, "groups": groups}
+    return {
+        "success": True,
+        "phash": phash_str,
+        "groups": groups,
+        "cache": {"hits": cache_hits, "misses": len(images) - cache_hits}
+    }
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit rates and sizes of the hash cache, Gemini result cache and Gemini upload registry"""
+    return {
+        "hashes": hash_cache.stats(),
+        "gemini": gemini_cache.stats(),
+        "gemini_files": gemini_files.stats()
+    }
+
+@app.get("/api/gemini/stats")
+async def gemini_stats():
+    """Request, retry and throttling counters of the shared Gemini scheduler"""
+    return gemini_scheduler.stats()
+
+# Response headers worth passing on from a cloud download
+PASSTHROUGH_HEADERS = ('content-length', 'content-range', 'accept-ranges', 'etag', 'last-modified')
+
+def passthrough_response(upstream: httpx.Response, media_type: str, filename: str, chunk_size: int) -> Response:
+    """
+    Stream an upstream download to the client as it arrives, keeping its status (200, 206 or 416)
+    and range headers. The upstream response is closed once the client has it
+    """
+    if upstream.status_code == 416:
+        # The requested range starts past the end of the file
+        return Response(
+            status_code=416,
+            headers={'Content-Range': upstream.headers.get('content-range', 'bytes */*')},
+            background=BackgroundTask(upstream.aclose)
+        )
+    
+    headers = {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS if name in upstream.headers}
+    headers.setdefault('accept-ranges', 'bytes')
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    
+    # Return file as streaming response
+    return StreamingResponse(
+        upstream.aiter_raw(chunk_size),
+        status_code=upstream.status_code,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(upstream.aclose)
+    )
+
 @app.get("/api/drive/download/{file_id}")
 async def download_file(file_id: str, request: Request):
-    """Download a file from Google Drive"""
+    """Download a file from Google Drive, streamed through as it arrives. Supports Range requests"""
     session_id = request.cookies.get("session_id")
     
     if not session_id or session_id not in sessions:
@@ -408,37 +510,33 @@ async def download_file(file_id: str, request: Request):
     
     try:
         credentials = get_credentials_from_session(session_id)
-        service = build('drive', 'v3', credentials=credentials, static_discovery=False)
+        service = get_drive_service()
         
         # Get file metadata
-        file_metadata = service.files().get(fileId=file_id, fields='name,mimeType').execute()
-        
-        # Download file content
-        request_obj = service.files().get_media(fileId=file_id)
-        file_content = io.BytesIO()
+        file_metadata = await execute_async(service.files().get(fileId=file_id, fields='name,mimeType'), credentials)
         
-        from googleapiclient.http import MediaIoBaseDownload
-        downloader = MediaIoBaseDownload(file_content, request_obj)
-        
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        
-        # Reset file pointer
-        file_content.seek(0)
+        # Start the download, the body is read from Drive only as the client reads it
+        upstream = await open_media_stream(credentials, file_id, request.headers.get('range'))
+        if upstream.status_code == 404:
+            await upstream.aclose()
+            raise HTTPException(status_code=404, detail="File not found")
+        if upstream.status_code >= 400 and upstream.status_code != 416:
+            await upstream.aclose()
+            raise HTTPException(status_code=500, detail=f"Drive API Error: {upstream.status_code}")
         
         # Update session with potentially refreshed token
         update_session_token(session_id, credentials)
         
-        # Return file as streaming response
-        return StreamingResponse(
-            file_content,
-            media_type=file_metadata.get('mimeType', 'application/octet-stream'),
-            headers={
-                'Content-Disposition': f'attachment; filename="{file_metadata.get("name", "file")}"'
-            }
+        return passthrough_response(
+            upstream,
+            file_metadata.get('mimeType', 'application/octet-stream'),
+            file_metadata.get("name", "file"),
+            DRIVE_DOWNLOAD_CHUNK_SIZE
         )
     
+    except HTTPException:
+        raise
+    
     except HttpError as error:
         if error.resp.status == 404:
             raise HTTPException(status_code=404, detail="File not found")
@@ -447,9 +545,30 @@ async def download_file(file_id: str, request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
 
+async def get_drive_listing(session_id: str, credentials: Credentials, folder_id: str, refresh: bool = False) -> Tuple[FolderListing, bool]:
+    """The session's listing of a Drive folder brought up to date, and whether that was done incrementally"""
+    listings = sessions[session_id].setdefault("listings", ListingCache())
+    
+    # Listing and updating block, so keep them off the event loop
+    listing = None if refresh else listings.get(folder_id)
+    incremental = listing is not None
+    if listing is not None:
+        try:
+            listing = await asyncio.to_thread(drive.update_folder_listing, credentials, listing)
+        except HttpError as error:
+            # The page token is no longer valid, list from scratch
+            if error.resp.status not in (400, 404, 410):
+                raise
+            listing = None
+    if listing is None:
+        incremental = False
+        listing = await asyncio.to_thread(drive.list_folder, credentials, folder_id)
+    listings.put(listing)
+    return listing, incremental
+
 @app.get("/api/drive/folder-images/{folder_id}")
-async def get_folder_images(folder_id: str, request: Request):
-    """Get all image files from a folder (recursively)"""
+async def get_folder_images(folder_id: str, request: Request, refresh: bool = False):
+    """Get all image files from a folder (recursively), updating the session's last listing of it if there is one"""
     session_id = request.cookies.get("session_id")
     
     if not session_id or session_id not in sessions:
@@ -457,52 +576,8 @@ async def get_folder_images(folder_id: str, request: Request):
     
     try:
         credentials = get_credentials_from_session(session_id)
-        service = build('drive', 'v3', credentials=credentials, static_discovery=False)
-        
-        def get_images_recursive(folder_id: str) -> List[dict]:
-            """Recursively get all images from folder and subfolders"""
-            images = []
-            
-            # Query for files in this folder
-            query = f"'{folder_id}' in parents and trashed=false"
-            page_token = None
-            
-            while True:
-                results = service.files().list(
-                    q=query,
-                    fields="nextPageToken, files(id, name, mimeType, modifiedTime, size, thumbnailLink, webViewLink)",
-                    pageToken=page_token,
-                    pageSize=100
-                ).execute()
-                
-                files = results.get('files', [])
-                
-                for file in files:
-                    mime_type = file.get('mimeType', '')
-                    
-                    # If it's a folder, recurse into it
-                    if mime_type == 'application/vnd.google-apps.folder':
-                        images.extend(get_images_recursive(file['id']))
-                    
-                    # If it's an image, add it to the list
-                    elif mime_type.startswith('image/'):
-                        images.append({
-                            'id': file['id'],
-                            'name': file['name'],
-                            'mimeType': mime_type,
-                            'url': file.get('webViewLink'),
-                            'thumbnailUrl': file.get('thumbnailLink'),
-                            'sizeBytes': file.get('size')
-                        })
-                
-                page_token = results.get('nextPageToken')
-                if not page_token:
-                    break
-            
-            return images
-        
-        # Get all images from folder
-        images = get_images_recursive(folder_id)
+        listing, incremental = await get_drive_listing(session_id, credentials, folder_id, refresh)
+        images = listing.files()
         
         # Update session with potentially refreshed token
         update_session_token(session_id, credentials)
@@ -510,7 +585,8 @@ async def get_folder_images(folder_id: str, request: Request):
         return {
             "success": True,
             "files": images,
-            "count": len(images)
+            "count": len(images),
+            "incremental": incremental
         }
     
     except HttpError as error:
@@ -655,8 +731,11 @@ async def get_onedrive_client_id():
     return {"client_id": MICROSOFT_CLIENT_ID}
 
 @app.get("/api/onedrive/download/{file_id}")
-async def download_onedrive_file(file_id: str, request: Request):
-    """Download a file from OneDrive"""
+async def download_onedrive_file(file_id: str, request: Request, redirect: bool = False):
+    """
+    Download a file from OneDrive, streamed through as it arrives. Supports Range requests.
+    With redirect the client is sent to OneDrive's pre-authenticated download URL instead of proxying
+    """
     session_id = request.cookies.get("onedrive_session_id")
     
     if not session_id or session_id not in onedrive_sessions:
@@ -664,139 +743,305 @@ async def download_onedrive_file(file_id: str, request: Request):
     
     try:
         credentials = get_onedrive_credentials(session_id)
-        access_token = credentials['access_token']
         
-        # Get file download URL from Microsoft Graph API
-        async with httpx.AsyncClient() as client:
-            # First, get file metadata
-            headers = {
-                'Authorization': f'Bearer {access_token}'
-            }
-            
-            graph_url = f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}'
-            response = await client.get(graph_url, headers=headers)
-            
-            if response.status_code == 401:
-                # Token might be expired, try to refresh
-                access_token = await refresh_access_token(session_id)
-                headers['Authorization'] = f'Bearer {access_token}'
-                response = await client.get(graph_url, headers=headers)
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Failed to get file metadata: {response.text}"
-                )
-            
-            file_data = response.json()
-            
-            # Get download URL
-            download_url = file_data.get('@microsoft.graph.downloadUrl')
-            if not download_url:
-                raise HTTPException(status_code=404, detail="Download URL not found")
-            
-            # Download the file
-            file_response = await client.get(download_url)
-            
-            if file_response.status_code != 200:
-                raise HTTPException(
-                    status_code=file_response.status_code,
-                    detail="Failed to download file"
-                )
-            
-            # Return file as streaming response
-            return StreamingResponse(
-                io.BytesIO(file_response.content),
-                media_type=file_data.get('file', {}).get('mimeType', 'application/octet-stream'),
-                headers={
-                    'Content-Disposition': f'attachment; filename="{file_data.get("name", "file")}"'
-                }
+        # Get file metadata and its download URL from Microsoft Graph API
+        file_data = await get_item(file_id, credentials['access_token'], lambda: refresh_access_token(session_id))
+        
+        # Get download URL
+        download_url = file_data.get('@microsoft.graph.downloadUrl')
+        if not download_url:
+            raise HTTPException(status_code=404, detail="Download URL not found")
+        
+        if redirect:
+            # The URL carries its own short-lived authorization, so the client can fetch it directly
+            return RedirectResponse(download_url, status_code=307)
+        
+        # Start the download, the body is read from OneDrive only as the client reads it
+        upstream = await open_download_stream(download_url, request.headers.get('range'))
+        if upstream.status_code >= 400 and upstream.status_code != 416:
+            await upstream.aclose()
+            raise HTTPException(
+                status_code=upstream.status_code,
+                detail="Failed to download file"
             )
+        
+        return passthrough_response(
+            upstream,
+            file_data.get('file', {}).get('mimeType', 'application/octet-stream'),
+            file_data.get("name", "file"),
+            ONEDRIVE_DOWNLOAD_CHUNK_SIZE
+        )
     
+    except GraphError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading OneDrive file: {str(e)}")
 
+async def get_onedrive_listing(session_id: str, folder_id: str, refresh: bool = False) -> Tuple[FolderListing, bool]:
+    """The session's listing of a OneDrive folder brought up to date, and whether that was done incrementally"""
+    credentials = get_onedrive_credentials(session_id)
+    refresh_token = lambda: refresh_access_token(session_id)
+    listings = credentials.setdefault("listings", ListingCache())
+    
+    listing = None if refresh else listings.get(folder_id)
+    incremental = listing is not None
+    if listing is not None:
+        listing = await onedrive.update_folder_listing(listing, credentials['access_token'], refresh_token)
+    if listing is None:
+        incremental = False
+        # Read the token again, the update may have refreshed it
+        listing = await onedrive.list_folder(folder_id, credentials['access_token'], refresh_token)
+    listings.put(listing)
+    return listing, incremental
+
 @app.get("/api/onedrive/folder-images/{folder_id}")
-async def get_onedrive_folder_images(folder_id: str, request: Request):
-    """Get all image files from a OneDrive folder (recursively)"""
+async def get_onedrive_folder_images(folder_id: str, request: Request, refresh: bool = False):
+    """Get all image files from a OneDrive folder (recursively), updating the session's last listing of it if there is one"""
     session_id = request.cookies.get("onedrive_session_id")
     
     if not session_id or session_id not in onedrive_sessions:
         raise HTTPException(status_code=401, detail="Not authenticated with OneDrive")
     
     try:
-        credentials = get_onedrive_credentials(session_id)
-        access_token = credentials['access_token']
+        listing, incremental = await get_onedrive_listing(session_id, folder_id, refresh)
+        images = listing.files()
         
-        async def get_images_recursive(folder_id: str, client: httpx.AsyncClient) -> list:
-            """Recursively get all images from folder and subfolders"""
-            images = []
+        return {
+            "success": True,
+            "files": images,
+            "count": len(images),
+            "incremental": incremental
+        }
+    
+    except GraphError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting OneDrive folder images: {str(e)}")
+
+async def cluster_near_duplicates(images: List[ImageContainer]) -> List[List[ImageContainer]]:
+    """
+    Cluster images with the same pHash grouping as /api/compute/phash-group.
+    Every image ends up in exactly one cluster, clusters are ordered by their first image.
+    """
+    def lookup_cached():
+        return [hash_cache.get_hashes(img.content_digest()) or {} for img in images]
+    
+    hashes = [cached.get('phash') for cached in await asyncio.to_thread(lookup_cached)]
+    to_hash = [i for i, phash in enumerate(hashes) if phash is None]
+    results = await compute_phashes_from_paths([images[i].filepath for i in to_hash])
+    new_hashes = {}
+    for i, result in zip(to_hash, results):
+        # Images that can't be hashed just stay on their own
+        if not isinstance(result, BaseException):
+            hashes[i] = result
+            new_hashes[images[i].content_digest()] = result
+    await asyncio.to_thread(store_phashes, new_hashes)
+    
+    hashed = [i for i, phash in enumerate(hashes) if phash is not None]
+    cluster_of = {}
+    for group in group_similar([int(hashes[i], 16) for i in hashed], SIMILARITY_THRESHOLD, backend="numpy"):
+        for j in group:
+            cluster_of[hashed[j]] = hashed[group[0]]
+    
+    clusters: Dict[int, List[ImageContainer]] = {}
+    for i, img in enumerate(images):
+        clusters.setdefault(cluster_of.get(i, i), []).append(img)
+    return list(clusters.values())
+
+async def run_inference_pipeline(folder: Path, digests: Dict[str, str], collapse_duplicates: bool = False) -> AsyncIterator[dict]:
+    """
+    Read every image in folder that has an entry in digests, i.e. every file that was saved in full,
+    and send them to Gemini in concurrent batches.
+    Yields SSE 'stage' event dicts as each image completes a stage (read, uploaded, inferred),
+    and each image's result as soon as its batch finishes.
+    With collapse_duplicates, only one image per near-duplicate cluster is sent to Gemini
+    and its result is copied to the rest of the cluster.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    
+    def report(stage: str, img_container: ImageContainer):
+        # Called from worker threads as well as the event loop
+        loop.call_soon_threadsafe(events.put_nowait, ('stage', stage, img_container))
+    
+    async def pipeline():
+        try:
+            # Images are loaded lazily so no decoded bitmaps are held for the whole upload
+            data_loader = DataLoader(folder_path=str(folder), objs=None)
             
-            headers = {
-                'Authorization': f'Bearer {access_token}'
-            }
+            def scan() -> Iterator[ImageContainer]:
+                # Runs on a worker thread, reading the headers is blocking work
+                count = 0
+                for img_container in data_loader.iter_images_from_folder_path(report, paths=list(digests)):
+                    # Reuse the digests computed while saving so the result cache doesn't re-read the files
+                    img_container.digest = digests.get(img_container.filepath)
+                    count += 1
+                    yield img_container
+                loop.call_soon_threadsafe(events.put_nowait, ('loaded', count, data_loader.scan_stats))
+            
+            # Batches are sent to Gemini as the scan reaches them
+            representatives = scan()
+            if collapse_duplicates:
+                # Clustering compares every image with every other, so it has to wait for the whole scan
+                images = await asyncio.to_thread(lambda: list(representatives))
+                if not images:
+                    return
+                # Only the first image of each near-duplicate cluster goes to Gemini
+                clusters = await cluster_near_duplicates(images)
+                representatives = [cluster[0] for cluster in clusters]
+                followers.update({id(cluster[0]): cluster[1:] for cluster in clusters})
+                await events.put(('collapsed', len(representatives)))
             
-            # Get folder contents
-            graph_url = f'https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}/children'
-            response = await client.get(graph_url, headers=headers)
+            # Batches run concurrently, results are sent as soon as each batch finishes
+            async for batch, processed_batch in processor.gemini_inference_batched_async(representatives, on_progress=report):
+                await events.put(('batch', batch, processed_batch))
+        except Exception as e:
+            await events.put(('error', e))
+        finally:
+            await events.put(('done',))
+    
+    # Near-duplicates of each representative image, keyed by the representative's id
+    followers: Dict[int, List[ImageContainer]] = {}
+    # Filenames handed out to fanned-out results, so copies never share a name
+    taken_names: set = set()
+    
+    task = asyncio.create_task(pipeline())
+    stage_counts = defaultdict(int)
+    total = len(digests)
+    sent = 0
+    failed = 0
+    
+    try:
+        yield {'status': 'processing', 'message': f'Sending {total} images to Gemini...'}
+        while True:
+            kind, *payload = await events.get()
             
-            if response.status_code == 401:
-                # Token might be expired, try to refresh
-                new_token = await refresh_access_token(session_id)
-                headers['Authorization'] = f'Bearer {new_token}'
-                response = await client.get(graph_url, headers=headers)
+            if kind == 'stage':
+                stage, img_container = payload
+                stage_counts[stage] += 1
+                yield {
+                    'status': 'stage',
+                    'stage': stage,
+                    'progress': stage_counts[stage],
+                    'total': total,
+                    'file': os.path.basename(img_container.filepath),
+                    'bytes': img_container.upload_bytes if stage == STAGE_UPLOADED else None,
+                    'message': f'{stage.capitalize()} {stage_counts[stage]}/{total}'
+                }
             
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Failed to get folder contents: {response.text}"
-                )
+            elif kind == 'loaded':
+                image_count, scan_stats = payload
+                yield {
+                    'status': 'processing',
+                    'message': f"Read {scan_stats['files']} files at {scan_stats['files_per_sec']:.0f} files/sec, {scan_stats['errors']} skipped",
+                    'scan': scan_stats
+                }
+                if not image_count:
+                    yield {'status': 'error', 'message': 'No valid images found'}
+                    return
+                # Files that couldn't be read are left out of the progress from here on
+                total = image_count
             
-            items = response.json().get('value', [])
+            elif kind == 'collapsed':
+                yield {'status': 'processing', 'message': f'Collapsed {total} images into {payload[0]} distinct scenes'}
             
-            for item in items:
-                # If it's a folder, recurse into it
-                if 'folder' in item:
-                    sub_images = await get_images_recursive(item['id'], client)
-                    images.extend(sub_images)
+            elif kind == 'batch':
+                batch, processed_batch = payload
+                if processed_batch is None:
+                    failed += len(batch) + sum(len(followers.get(id(img), [])) for img in batch)
+                    yield {'status': 'processing', 'message': f'Gemini processing failed for {len(batch)} images'}
+                    continue
                 
-                # If it's an image file
-                elif 'file' in item:
-                    mime_type = item.get('file', {}).get('mimeType', '')
-                    if mime_type.startswith('image/'):
-                        images.append({
-                            'id': item['id'],
-                            'name': item['name'],
-                            'mimeType': mime_type,
-                            'url': item.get('webUrl'),
-                            'thumbnailUrl': item.get('thumbnails', [{}])[0].get('large', {}).get('url') if item.get('thumbnails') else None,
-                            'sizeBytes': item.get('size')
-                        })
+                # Copy each representative's result to its near-duplicates, giving every result a unique name
+                results = []
+                for img_container in processed_batch:
+                    if not img_container.gemini_response:
+                        # Gemini gave no valid result for it even after the follow-up requests
+                        failed += 1 + len(followers.get(id(img_container), []))
+                        continue
+                    results.append(img_container)
+                    members = followers.get(id(img_container), [])
+                    fan_out_response(img_container, members, taken_names)
+                    for member in members:
+                        stage_counts[STAGE_INFERRED] += 1
+                        results.append(member)
+                        yield {
+                            'status': 'stage',
+                            'stage': STAGE_INFERRED,
+                            'progress': stage_counts[STAGE_INFERRED],
+                            'total': total,
+                            'file': os.path.basename(member.filepath),
+                            'message': f'Inferred {stage_counts[STAGE_INFERRED]}/{total} (copied from a near-duplicate)'
+                        }
+                
+                for img_container in results:
+                    yield {
+                        'status': 'result',
+                        'index': sent,
+                        'total': total,
+                        'original_name': os.path.basename(img_container.filepath),
+                        'result': img_container.gemini_response
+                    }
+                    sent += 1
             
-            return images
-        
-        # Get all images from folder
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            images = await get_images_recursive(folder_id, client)
+            elif kind == 'error':
+                yield {'status': 'error', 'message': f'Processing error: {str(payload[0])}'}
+                return
+            
+            else:
+                break
         
-        return {
-            "success": True,
-            "files": images,
-            "count": len(images)
-        }
+        if sent == 0:
+            yield {'status': 'error', 'message': 'Gemini processing failed'}
+        elif failed:
+            yield {'status': 'complete', 'message': f'Processed {sent} images, {failed} failed'}
+        else:
+            yield {'status': 'complete', 'message': 'All images processed successfully'}
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting OneDrive folder images: {str(e)}")
+    finally:
+        # Stop the pipeline if the client went away before it finished
+        task.cancel()
+
+async def remove_temp_dir(temp_dir: Path):
+    """Delete a request's temp folder, retrying while Windows still holds its files open"""
+    # Windows-compatible cleanup with retry logic
+    import gc
+    
+    # Force garbage collection to release file handles
+    gc.collect()
+    
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            # Try to remove the directory
+            shutil.rmtree(temp_dir, ignore_errors=False)
+            print(f"Cleaned up {temp_dir}")
+            break
+        except PermissionError as e:
+            if attempt < max_retries - 1:
+                print(f"Cleanup attempt {attempt + 1} failed, retrying in 1 second...")
+                await asyncio.sleep(1)
+            else:
+                # Last attempt - use ignore_errors
+                print(f"Warning: Could not clean up all files in {temp_dir}: {e}")
+                try:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                except:
+                    pass
+        except Exception as e:
+            print(f"Error cleaning up temp files: {e}")
+            break
 
 @app.post("/api/upload")
-async def upload_images(files: List[UploadFile] = File(...)):
+async def upload_images(files: List[UploadFile] = File(...), collapse_duplicates: bool = False):
     """
     Upload images and process them with Gemini Vision Pro.
     Streams results back to the client as Server-Sent Events (SSE).
+    With collapse_duplicates, near-duplicate images share one Gemini result.
     """
     if processor is None:
         raise HTTPException(status_code=500, detail="ImageProcessor not initialized. Check Gemini API setup.")
@@ -805,20 +1050,26 @@ async def upload_images(files: List[UploadFile] = File(...)):
         raise HTTPException(status_code=400, detail="No files provided")
     
     # CRITICAL FIX: Save files BEFORE creating the generator
-    temp_dir = Path("./temp_uploads")
-    temp_dir.mkdir(exist_ok=True)
+    # Each request gets its own folder so concurrent uploads don't clean up each other's files
+    temp_dir = Path("./temp_uploads") / secrets.token_hex(8)
+    temp_dir.mkdir(parents=True, exist_ok=True)
     
     file_count = len(files)
     print(f"Starting upload of {file_count} files...")
     
+    # Content digest of each saved file, keyed by its path on disk
+    digests: Dict[str, str] = {}
+    # Name and size of each saved file, in the order they were saved
+    saved: List[tuple] = []
+    
     try:
-        # Save all files immediately
+        # Stream every file to disk in chunks rather than reading it into memory
         for i, file in enumerate(files):
             file_path = temp_dir / f"{i}_{file.filename}"
-            content = await file.read()
-            with open(file_path, "wb") as buffer:
-                buffer.write(content)
-            print(f"Saved: {file.filename} -> {file_path}")
+            digest, size = await save_upload(file, file_path)
+            digests[str(file_path)] = digest
+            saved.append((file.filename, size))
+            print(f"Saved: {file.filename} -> {file_path} ({size} bytes)")
         
     except Exception as e:
         try:
@@ -832,70 +1083,156 @@ async def upload_images(files: List[UploadFile] = File(...)):
         try:
             yield f"data: {json.dumps({'status': 'uploading', 'message': f'Received {file_count} files'})}\n\n"
             
-            for i in range(file_count):
-                yield f"data: {json.dumps({'status': 'uploading', 'progress': i + 1, 'total': file_count})}\n\n"
+            # Files are saved before the stream starts, so report each save as it happened
+            for i, (name, size) in enumerate(saved):
+                yield f"data: {json.dumps({'status': 'uploading', 'stage': 'saved', 'progress': i + 1, 'total': file_count, 'file': name, 'bytes': size})}\n\n"
             
             yield f"data: {json.dumps({'status': 'processing', 'message': 'Loading images...'})}\n\n"
             
-            data_loader = DataLoader(folder_path=str(temp_dir), objs=None)
-            images = data_loader.load_images_from_folder_path()
+            async for event in run_inference_pipeline(temp_dir, digests, collapse_duplicates):
+                yield f"data: {json.dumps(event)}\n\n"
             
-            if not images:
-                yield f"data: {json.dumps({'status': 'error', 'message': 'No valid images found'})}\n\n"
-                return
+        except Exception as e:
+            yield f"data: {json.dumps({'status': 'error', 'message': f'Processing error: {str(e)}'})}\n\n"
+        
+        finally:
+            await remove_temp_dir(temp_dir)
+    
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+class CloudImportRequest(BaseModel):
+    """Files to import from a cloud provider, given by id, as every image under a folder, or both"""
+    provider: Literal['drive', 'onedrive']
+    file_ids: List[str] = []
+    folder_id: str | None = None
+
+@app.post("/api/import")
+async def import_cloud_images(body: CloudImportRequest, request: Request, collapse_duplicates: bool = False):
+    """
+    Import images straight from Google Drive or OneDrive and process them like /api/upload.
+    The server downloads the files itself, IMPORT_CONCURRENCY at a time, so they never pass through the browser.
+    Streams download progress and then results back to the client as Server-Sent Events (SSE).
+    """
+    if processor is None:
+        raise HTTPException(status_code=500, detail="ImageProcessor not initialized. Check Gemini API setup.")
+    
+    if not body.file_ids and not body.folder_id:
+        raise HTTPException(status_code=400, detail="No files or folder provided")
+    
+    # Resolve the files before the stream starts, so auth and listing errors get a proper status code
+    # File id -> name, None if it has to be looked up
+    files: Dict[str, str | None] = dict.fromkeys(body.file_ids)
+    try:
+        if body.provider == 'drive':
+            session_id = request.cookies.get("session_id")
+            if not session_id or session_id not in sessions:
+                raise HTTPException(status_code=401, detail="Not authenticated")
+            credentials = get_credentials_from_session(session_id)
+            if body.folder_id:
+                listing, _ = await get_drive_listing(session_id, credentials, body.folder_id)
+                files.update({image['id']: image['name'] for image in listing.files()})
             
-            yield f"data: {json.dumps({'status': 'processing', 'message': f'Sending {len(images)} images to Gemini...'})}\n\n"
+            async def open_file(file_id: str, name: str | None) -> Tuple[str, httpx.Response]:
+                if name is None:
+                    metadata = get_drive_service().files().get(fileId=file_id, fields="name")
+                    name = (await execute_async(metadata, credentials))['name']
+                return name, await open_media_stream(credentials, file_id)
+        else:
+            session_id = request.cookies.get("onedrive_session_id")
+            if not session_id or session_id not in onedrive_sessions:
+                raise HTTPException(status_code=401, detail="Not authenticated with OneDrive")
+            onedrive_credentials = get_onedrive_credentials(session_id)
+            if body.folder_id:
+                listing, _ = await get_onedrive_listing(session_id, body.folder_id)
+                files.update({image['id']: image['name'] for image in listing.files()})
+            
+            async def open_file(file_id: str, name: str | None) -> Tuple[str, httpx.Response]:
+                # Download URLs are only valid for a short while, so fetch a fresh one for every file
+                item = await get_item(file_id, onedrive_credentials['access_token'], lambda: refresh_access_token(session_id))
+                if 'file' not in item:
+                    raise ValueError("not a file")
+                return item['name'], await open_download_stream(item['@microsoft.graph.downloadUrl'])
+    
+    except HttpError as error:
+        if error.resp.status == 404:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        raise HTTPException(status_code=500, detail=f"Drive API Error: {str(error)}")
+    except GraphError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    if not files:
+        raise HTTPException(status_code=400, detail="No images found")
+    
+    temp_dir = Path("./temp_uploads") / secrets.token_hex(8)
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    file_count = len(files)
+    print(f"Starting import of {file_count} files from {body.provider}...")
+    
+    # Files being downloaded at once, and upload_budget caps the bytes they buffer between them
+    downloads = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    
+    async def fetch(index: int, file_id: str, name: str | None) -> tuple:
+        """Download one file into temp_dir, returns its name, path, digest and size, or its name and the error"""
+        async with downloads:
+            try:
+                name, upstream = await open_file(file_id, name)
+                try:
+                    if upstream.status_code >= 400:
+                        raise ValueError(f"download failed with status {upstream.status_code}")
+                    # Cloud file names may contain slashes
+                    file_path = temp_dir / f"{index}_{Path(name).name}"
+                    digest, size = await save_stream(upstream, file_path)
+                finally:
+                    await upstream.aclose()
+                return name, file_path, digest, size, None
+            except Exception as e:
+                return name or file_id, None, None, None, e
+    
+    async def generate_stream():
+        """Generator function that yields SSE events"""
+        tasks = [asyncio.create_task(fetch(i, file_id, name)) for i, (file_id, name) in enumerate(files.items())]
+        try:
+            yield f"data: {json.dumps({'status': 'uploading', 'message': f'Importing {file_count} files'})}\n\n"
             
-            processed_images = processor.gemini_inference(images)
+            # Content digest of each saved file, keyed by its path on disk
+            digests: Dict[str, str] = {}
+            for next_file in asyncio.as_completed(tasks):
+                name, file_path, digest, size, error = await next_file
+                if error is not None:
+                    print(f"Could not import {name}: {error}")
+                    yield f"data: {json.dumps({'status': 'uploading', 'stage': 'failed', 'file': name, 'message': f'Could not import {name}: {error}'})}\n\n"
+                    continue
+                digests[str(file_path)] = digest
+                yield f"data: {json.dumps({'status': 'uploading', 'stage': 'saved', 'progress': len(digests), 'total': file_count, 'file': name, 'bytes': size})}\n\n"
             
-            if processed_images is None:
-                yield f"data: {json.dumps({'status': 'error', 'message': 'Gemini processing failed'})}\n\n"
+            if not digests:
+                yield f"data: {json.dumps({'status': 'error', 'message': 'No files could be imported'})}\n\n"
                 return
             
-            for i, img_container in enumerate(processed_images):
-                result_data = {
-                    'status': 'result',
-                    'index': i,
-                    'total': len(processed_images),
-                    'original_name': os.path.basename(img_container.filepath),
-                    'result': img_container.gemini_response
-                }
-                yield f"data: {json.dumps(result_data)}\n\n"
+            yield f"data: {json.dumps({'status': 'processing', 'message': 'Loading images...'})}\n\n"
             
-            yield f"data: {json.dumps({'status': 'complete', 'message': 'All images processed successfully'})}\n\n"
+            async for event in run_inference_pipeline(temp_dir, digests, collapse_duplicates):
+                yield f"data: {json.dumps(event)}\n\n"
             
         except Exception as e:
             yield f"data: {json.dumps({'status': 'error', 'message': f'Processing error: {str(e)}'})}\n\n"
         
         finally:
-            # Windows-compatible cleanup with retry logic
-            import time
-            import gc
-            
-            # Force garbage collection to release file handles
-            gc.collect()
-            
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    # Try to remove the directory
-                    shutil.rmtree(temp_dir, ignore_errors=False)
-                    print(f"Cleaned up {temp_dir}")
-                    break
-                except PermissionError as e:
-                    if attempt < max_retries - 1:
-                        print(f"Cleanup attempt {attempt + 1} failed, retrying in 1 second...")
-                        time.sleep(1)
-                    else:
-                        # Last attempt - use ignore_errors
-                        print(f"Warning: Could not clean up all files in {temp_dir}: {e}")
-                        try:
-                            shutil.rmtree(temp_dir, ignore_errors=True)
-                        except:
-                            pass
-                except Exception as e:
-                    print(f"Error cleaning up temp files: {e}")
-                    break
+            # Stop any downloads still running if the client went away, and let them close their files
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if body.provider == 'drive' and session_id in sessions:
+                update_session_token(session_id, credentials)
+            await remove_temp_dir(temp_dir)
     
     return StreamingResponse(
         generate_stream(),
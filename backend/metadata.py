@@ -0,0 +1,617 @@
+from typing import Dict, List, Sequence, Tuple
+from xml.etree import ElementTree
+import atexit
+import concurrent.futures
+import itertools
+import os
+import queue
+import re
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+
+
+EXIFTOOL_PATH = os.getenv('EXIFTOOL_PATH', 'exiftool')
+EXIFTOOL_WORKERS = int(os.getenv('EXIFTOOL_WORKERS', '2'))
+# Commands written to a worker before reading its replies. exiftool prints a few lines per file,
+# so this keeps the replies well inside the pipe buffer while the commands are still being written
+EXIFTOOL_BATCH_SIZE = int(os.getenv('EXIFTOOL_BATCH_SIZE', '200'))
+# Write JPEG and PNG metadata in Python, leaving exiftool for everything else (e.g. HEIC)
+NATIVE_METADATA = os.getenv('NATIVE_METADATA', '1') != '0'
+
+
+class ExifToolError(RuntimeError):
+    """ Raised when an exiftool worker dies, outputs holds the replies to the commands it finished first """
+
+    def __init__(self, message: str, outputs: List[str] | None = None) -> None:
+        super().__init__(message)
+        self.outputs = outputs or []
+
+
+class ExifToolProcess:
+    """
+    A single long-lived exiftool reading commands from stdin (-stay_open True -@ -), so the Perl
+    startup cost is paid once instead of for every file. Not thread safe, see ExifToolPool
+    """
+
+    def __init__(self, executable: str = EXIFTOOL_PATH) -> None:
+        self.executable = executable
+        self._process: subprocess.Popen | None = None
+        self._sequence = itertools.count()
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self) -> None:
+        # stderr is merged into stdout so error messages arrive in order, just before the reply marker
+        self._process = subprocess.Popen(
+            [self.executable, '-stay_open', 'True', '-@', '-', '-common_args', '-charset', 'filename=utf8'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+        )
+
+    def execute_many(self, commands: Sequence[Sequence[str]]) -> List[str]:
+        """
+        Sends every command in one write and then collects the replies
+
+        Parameters
+        ----------
+        commands : Sequence[Sequence[str]]
+            The arguments of each exiftool command, without the 'exiftool' itself
+
+        Return
+        ------
+        List[str]
+            The output of each command, in order
+
+        Raises
+        ------
+        ExifToolError
+            If the process exits before answering every command
+        """
+        if not self.running:
+            self.start()
+
+        markers = []
+        lines = []
+        for args in commands:
+            number = next(self._sequence)
+            markers.append(f'{{ready{number}}}')
+            # Arguments are newline separated in the argument file, so they can't contain newlines themselves
+            lines.extend(arg.replace('\r', ' ').replace('\n', ' ') for arg in args)
+            lines.append(f'-execute{number}')
+
+        try:
+            self._process.stdin.write('\n'.join(lines) + '\n')
+            self._process.stdin.flush()
+        except OSError as e:
+            self.close()
+            raise ExifToolError(f'exiftool exited: {e}') from e
+
+        outputs = []
+        for marker in markers:
+            output = []
+            while True:
+                line = self._process.stdout.readline()
+                if not line:
+                    self.close()
+                    raise ExifToolError(f'exiftool exited after {len(outputs)} of {len(commands)} commands', outputs)
+                if line.rstrip() == marker:
+                    break
+                output.append(line)
+            outputs.append(''.join(output))
+        return outputs
+
+    def close(self) -> None:
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.write('-stay_open\nFalse\n')
+            process.stdin.flush()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+
+class ExifToolPool:
+    """ A fixed set of ExifToolProcesses shared between threads. Workers that crash are replaced """
+
+    def __init__(self, size: int = EXIFTOOL_WORKERS, executable: str = EXIFTOOL_PATH) -> None:
+        self.size = size
+        self._idle: queue.Queue[ExifToolProcess] = queue.Queue()
+        for _ in range(size):
+            self._idle.put(ExifToolProcess(executable))
+        self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+
+    def _run_chunk(self, commands: Sequence[Sequence[str]]) -> List[Tuple[bool, str]]:
+        worker = self._idle.get()
+        results: List[Tuple[bool, str]] = []
+        try:
+            # A file that crashes exiftool shouldn't fail the rest of the chunk. The command the process died on is
+            # marked failed and the ones after it go to a fresh process. Finished ones aren't resent, their renames
+            # already happened. Every crash consumes a command, so this ends after at most len(commands) restarts
+            while len(results) < len(commands):
+                try:
+                    outputs = worker.execute_many(commands[len(results):])
+                except ExifToolError as e:
+                    results.extend((command_succeeded(output), output) for output in e.outputs)
+                    if len(results) < len(commands):
+                        results.append((False, str(e)))
+                else:
+                    results.extend((command_succeeded(output), output) for output in outputs)
+        finally:
+            self._idle.put(worker)
+        return results
+
+    def run(self, commands: Sequence[Sequence[str]]) -> List[Tuple[bool, str]]:
+        """
+        Runs many exiftool commands, spread over the workers in chunks of EXIFTOOL_BATCH_SIZE
+
+        Return
+        ------
+        List[Tuple[bool, str]]
+            Whether each command succeeded and its output, in order
+
+        Raises
+        ------
+        FileNotFoundError
+            If exiftool isn't installed
+        """
+        chunks = [commands[i:i + EXIFTOOL_BATCH_SIZE] for i in range(0, len(commands), EXIFTOOL_BATCH_SIZE)]
+        results = []
+        for chunk_results in self._threads.map(self._run_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def close(self) -> None:
+        self._threads.shutdown()
+        while not self._idle.empty():
+            self._idle.get().close()
+
+
+_UPDATED = re.compile(r'\b[1-9]\d* image files (updated|created)')
+
+
+def command_succeeded(output: str) -> bool:
+    """ Reads exiftool's summary lines, e.g. '1 image files updated' """
+    return 'Error' not in output and _UPDATED.search(output) is not None
+
+
+def metadata_command(filepath: str, gemini_response: Dict[str, str]) -> List[str]:
+    """
+    The exiftool arguments that write a gemini_response to an image and rename it
+
+    Parameters
+    ----------
+    filepath : str
+        The image to update
+    gemini_response : Dict[str, str]
+        The 'name', 'tags' and 'description' for the image
+    """
+    new_filepath = os.path.split(filepath)[0] + '/' + gemini_response['name']
+    tag_string = ", ".join(gemini_response['tags'])
+    # -sep ',': Sets the separator for keywords to a comma
+    # -XMP:Subject+=: add to the list without overwriting existing tags
+    return [
+        '-sep', ',',
+        f'-EXIF:ImageDescription={gemini_response["description"]}',
+        f'-XMP:Subject+={tag_string}',
+        f'-IPTC:Keywords+={tag_string}',  # Also add to IPTC for maximum compatibility
+        f'-filename={new_filepath}',
+        filepath,
+    ]
+
+
+_pool: ExifToolPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_exiftool_pool() -> ExifToolPool:
+    """ The shared ExifToolPool, started on first use and closed at exit """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExifToolPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+# Native writer
+
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+XMP_PNG_KEYWORD = b'XML:com.adobe.xmp'
+PHOTOSHOP_HEADER = b'Photoshop 3.0\x00'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IPTC_RESOURCE = 0x0404
+IPTC_DIGEST_RESOURCE = 0x0425
+IPTC_KEYWORDS = (2, 25)
+IPTC_CHARSET = (1, 90)
+EXIF_IMAGE_DESCRIPTION = 0x010E
+TIFF_ASCII = 2
+IPTC_UTF8 = b'\x1b%G'
+IPTC_KEYWORD_LIMIT = 64
+
+_XMP_NAMESPACES = {
+    'x': 'adobe:ns:meta/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'xmp': 'http://ns.adobe.com/xap/1.0/',
+    'xmpMM': 'http://ns.adobe.com/xap/1.0/mm/',
+    'stEvt': 'http://ns.adobe.com/xap/1.0/sType/ResourceEvent#',
+    'stRef': 'http://ns.adobe.com/xap/1.0/sType/ResourceRef#',
+    'photoshop': 'http://ns.adobe.com/photoshop/1.0/',
+    'tiff': 'http://ns.adobe.com/tiff/1.0/',
+    'exif': 'http://ns.adobe.com/exif/1.0/',
+    'aux': 'http://ns.adobe.com/exif/1.0/aux/',
+    'crs': 'http://ns.adobe.com/camera-raw-settings/1.0/',
+    'Iptc4xmpCore': 'http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/',
+    'xmpRights': 'http://ns.adobe.com/xap/1.0/rights/',
+    'GPano': 'http://ns.google.com/photos/1.0/panorama/',
+    'hdrgm': 'http://ns.adobe.com/hdr-gain-map/1.0/',
+}
+for _prefix, _uri in _XMP_NAMESPACES.items():
+    ElementTree.register_namespace(_prefix, _uri)
+
+
+def _rdf(name: str) -> str:
+    return f"{{{_XMP_NAMESPACES['rdf']}}}{name}"
+
+
+def merge_xmp_subjects(xmp: bytes | None, tags: Sequence[str]) -> bytes:
+    """
+    Adds tags to the dc:subject bag of an XMP packet, keeping everything else in it
+
+    Parameters
+    ----------
+    xmp : bytes | None
+        The existing packet, or None to make a new one
+    tags : Sequence[str]
+        The keywords to add, ones already in the bag are skipped
+    """
+    if xmp:
+        root = ElementTree.fromstring(xmp)
+    else:
+        root = ElementTree.Element(f"{{{_XMP_NAMESPACES['x']}}}xmpmeta")
+        ElementTree.SubElement(root, _rdf('RDF'))
+    rdf = root if root.tag == _rdf('RDF') else root.find('rdf:RDF', _XMP_NAMESPACES)
+    if rdf is None:
+        raise ValueError('XMP packet has no rdf:RDF')
+
+    descriptions = rdf.findall('rdf:Description', _XMP_NAMESPACES)
+    description = next((d for d in descriptions if d.find('dc:subject', _XMP_NAMESPACES) is not None), None)
+    if description is None:
+        description = descriptions[0] if descriptions else ElementTree.SubElement(rdf, _rdf('Description'), {_rdf('about'): ''})
+    subject = description.find('dc:subject', _XMP_NAMESPACES)
+    if subject is None:
+        subject = ElementTree.SubElement(description, f"{{{_XMP_NAMESPACES['dc']}}}subject")
+    bag = subject.find('rdf:Bag', _XMP_NAMESPACES)
+    if bag is None:
+        bag = ElementTree.SubElement(subject, _rdf('Bag'))
+
+    existing = {li.text for li in bag}
+    for tag in tags:
+        if tag not in existing:
+            ElementTree.SubElement(bag, _rdf('li')).text = tag
+            existing.add(tag)
+
+    body = ElementTree.tostring(root, encoding='unicode')
+    return f'<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n{body}\n<?xpacket end="w"?>'.encode('utf-8')
+
+
+def set_exif_description(exif: bytes | None, description: str) -> bytes:
+    """
+    Sets EXIF ImageDescription in an Exif block (TIFF bytes, with or without the 'Exif\\0\\0' prefix of JPEG APP1),
+    returning the new TIFF bytes. Only that IFD0 entry changes: the new value, and a copy of IFD0 when the tag has
+    to be added, are appended to the end, so every other tag, the MakerNote and the thumbnail keep their bytes and offsets
+    """
+    # Written as UTF-8 like exiftool does
+    value = description.encode('utf-8') + b'\x00'
+    if exif and exif.startswith(b'Exif\x00\x00'):
+        exif = exif[6:]
+    if not exif:
+        # An empty IFD0 with no next IFD, the entry is added below
+        exif = b'II*\x00' + struct.pack('<IHI', 8, 0, 0)
+
+    order = {b'II': '<', b'MM': '>'}.get(exif[:2])
+    if order is None or struct.unpack(order + 'H', exif[2:4])[0] != 42:
+        raise ValueError('Malformed TIFF header')
+    ifd0 = struct.unpack(order + 'I', exif[4:8])[0]
+    if ifd0 + 2 > len(exif):
+        raise ValueError('IFD0 is outside the Exif block')
+    count = struct.unpack(order + 'H', exif[ifd0:ifd0 + 2])[0]
+    if ifd0 + 2 + 12 * count + 4 > len(exif):
+        raise ValueError('IFD0 is truncated')
+    entries = [exif[ifd0 + 2 + 12 * i:ifd0 + 14 + 12 * i] for i in range(count)]
+    tags = [struct.unpack(order + 'H', entry[:2])[0] for entry in entries]
+
+    data = bytearray(exif)
+    if len(value) <= 4:
+        field = value.ljust(4, b'\x00')
+    else:
+        # TIFF values start on a word boundary
+        data += b'\x00' * (len(data) % 2)
+        field = struct.pack(order + 'I', len(data))
+        data += value
+    entry = struct.pack(order + 'HHI', EXIF_IMAGE_DESCRIPTION, TIFF_ASCII, len(value)) + field
+
+    if EXIF_IMAGE_DESCRIPTION in tags:
+        start = ifd0 + 2 + 12 * tags.index(EXIF_IMAGE_DESCRIPTION)
+        data[start:start + 12] = entry
+    else:
+        # IFD0 can't grow where it is, so it moves to the end with the entry added in tag order.
+        # The old copy is left unreferenced and everything it pointed to stays where it was
+        entries.insert(sum(tag < EXIF_IMAGE_DESCRIPTION for tag in tags), entry)
+        next_ifd = exif[ifd0 + 2 + 12 * count:ifd0 + 6 + 12 * count]
+        data += b'\x00' * (len(data) % 2)
+        data[4:8] = struct.pack(order + 'I', len(data))
+        data += struct.pack(order + 'H', len(entries)) + b''.join(entries) + next_ifd
+    return bytes(data)
+
+
+def _read_iptc(data: bytes) -> List[Tuple[int, int, bytes]]:
+    datasets = []
+    position = 0
+    while position + 5 <= len(data) and data[position] == 0x1C:
+        record, dataset, length = struct.unpack('>BBH', data[position + 1:position + 5])
+        if length & 0x8000:
+            raise ValueError('Extended IPTC datasets are not supported')
+        datasets.append((record, dataset, data[position + 5:position + 5 + length]))
+        position += 5 + length
+    return datasets
+
+
+def _write_iptc(datasets: List[Tuple[int, int, bytes]]) -> bytes:
+    if any(len(value) >= 0x8000 for _, _, value in datasets):
+        raise ValueError('IPTC dataset too long for a standard dataset')
+    return b''.join(struct.pack('>BBBH', 0x1C, record, dataset, len(value)) + value for record, dataset, value in datasets)
+
+
+def add_iptc_keywords(iptc: bytes | None, tags: Sequence[str]) -> bytes:
+    """ Adds tags as IPTC Keywords to an IPTC-IIM block, skipping ones already there """
+    datasets = _read_iptc(iptc) if iptc else [(2, 0, b'\x00\x04')]
+    charsets = [value for record, dataset, value in datasets if (record, dataset) == IPTC_CHARSET]
+    if not charsets:
+        # Without a character set readers take the text as Latin-1 (exiftool reads it as cp1252), so
+        # existing non-ASCII text has to be converted before the block can be marked as UTF-8
+        try:
+            datasets = [
+                (record, dataset, value.decode('cp1252').encode('utf-8') if record == 2 and dataset != 0 else value)
+                for record, dataset, value in datasets
+            ]
+        except UnicodeDecodeError:
+            raise ValueError('IPTC block has text in an unknown character set')
+        datasets.append((*IPTC_CHARSET, IPTC_UTF8))
+    elif charsets[0] != IPTC_UTF8 and not all(tag.isascii() for tag in tags):
+        raise ValueError('IPTC block uses a character set other than UTF-8')
+
+    existing = {value for record, dataset, value in datasets if (record, dataset) == IPTC_KEYWORDS}
+    for tag in tags:
+        # Keywords are limited to 64 bytes, cut on a character boundary
+        value = tag.encode('utf-8')[:IPTC_KEYWORD_LIMIT].decode('utf-8', 'ignore').encode('utf-8')
+        if value not in existing:
+            datasets.append((*IPTC_KEYWORDS, value))
+            existing.add(value)
+    # Record 1 (the envelope with the character set) has to come before record 2
+    datasets.sort(key=lambda d: d[0])
+    return _write_iptc(datasets)
+
+
+def _read_photoshop_resources(data: bytes) -> List[Tuple[int, bytes, bytes]]:
+    resources = []
+    position = 0
+    while position + 12 <= len(data) and data[position:position + 4] == b'8BIM':
+        resource_id = struct.unpack('>H', data[position + 4:position + 6])[0]
+        name_length = data[position + 6]
+        # The Pascal name including its length byte is padded to an even length
+        name_end = position + 7 + name_length + ((name_length + 1) % 2)
+        name = data[position + 6:name_end]
+        size = struct.unpack('>I', data[name_end:name_end + 4])[0]
+        resources.append((resource_id, name, data[name_end + 4:name_end + 4 + size]))
+        position = name_end + 4 + size + (size % 2)
+    return resources
+
+
+def _write_photoshop_resources(resources: List[Tuple[int, bytes, bytes]]) -> bytes:
+    return b''.join(
+        b'8BIM' + struct.pack('>H', resource_id) + name + struct.pack('>I', len(value)) + value + b'\x00' * (len(value) % 2)
+        for resource_id, name, value in resources
+    )
+
+
+def set_photoshop_keywords(photoshop: bytes | None, tags: Sequence[str]) -> bytes:
+    """ Adds IPTC Keywords to the resources of a Photoshop APP13 segment (without its header) """
+    resources = _read_photoshop_resources(photoshop) if photoshop else []
+    iptc = next((value for resource_id, _, value in resources if resource_id == IPTC_RESOURCE), None)
+    new_iptc = add_iptc_keywords(iptc, tags)
+    # The IPTC digest would no longer match, so drop it rather than leave it stale
+    resources = [r for r in resources if r[0] != IPTC_DIGEST_RESOURCE]
+    if iptc is None:
+        resources.append((IPTC_RESOURCE, b'\x00\x00', new_iptc))
+    else:
+        resources = [(i, n, new_iptc if i == IPTC_RESOURCE else v) for i, n, v in resources]
+    return _write_photoshop_resources(resources)
+
+
+def _jpeg_segment(marker: int, payload: bytes) -> bytes:
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError(f'JPEG segment 0x{marker:02X} is too large')
+    return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+
+def update_jpeg(data: bytes, gemini_response: Dict[str, str]) -> bytes:
+    """ Rewrites the EXIF, XMP and IPTC segments of a JPEG, the compressed image data is copied untouched """
+    segments: List[Tuple[int, bytes]] = []
+    position = 2
+    while True:
+        if data[position] != 0xFF:
+            raise ValueError('Malformed JPEG marker')
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan, everything from here on is image data
+            break
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        segments.append((marker, data[position + 4:position + 2 + length]))
+        position += 2 + length
+    image_data = data[position:]
+
+    def find(marker: int, header: bytes) -> int | None:
+        return next((i for i, (m, p) in enumerate(segments) if m == marker and p.startswith(header)), None)
+
+    exif_index = find(0xE1, b'Exif\x00\x00')
+    xmp_index = find(0xE1, XMP_HEADER)
+    photoshop_index = find(0xED, PHOTOSHOP_HEADER)
+
+    exif = b'Exif\x00\x00' + set_exif_description(segments[exif_index][1] if exif_index is not None else None, gemini_response['description'])
+    xmp = XMP_HEADER + merge_xmp_subjects(segments[xmp_index][1][len(XMP_HEADER):] if xmp_index is not None else None, gemini_response['tags'])
+    photoshop = PHOTOSHOP_HEADER + set_photoshop_keywords(
+        segments[photoshop_index][1][len(PHOTOSHOP_HEADER):] if photoshop_index is not None else None, gemini_response['tags']
+    )
+
+    # Existing segments are replaced in place before any insert shifts the indexes
+    for index, marker, payload in ((exif_index, 0xE1, exif), (xmp_index, 0xE1, xmp), (photoshop_index, 0xED, photoshop)):
+        if index is not None:
+            segments[index] = (marker, payload)
+    if exif_index is None:
+        # Exif has to come straight after SOI, or after the JFIF segment if there is one
+        segments.insert(1 if segments and segments[0][0] == 0xE0 else 0, (0xE1, exif))
+    # Other new segments go after the leading APPn segments
+    insert_at = next((i for i, (m, _) in enumerate(segments) if not 0xE0 <= m <= 0xEF), len(segments))
+    if xmp_index is None:
+        segments.insert(insert_at, (0xE1, xmp))
+        insert_at += 1
+    if photoshop_index is None:
+        segments.insert(insert_at, (0xED, photoshop))
+    return b'\xff\xd8' + b''.join(_jpeg_segment(m, p) for m, p in segments) + image_data
+
+
+def _png_chunk(chunk_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload)) + chunk_type + payload + struct.pack('>I', zlib.crc32(chunk_type + payload))
+
+
+def update_png(data: bytes, gemini_response: Dict[str, str]) -> bytes:
+    """ Rewrites the eXIf and XMP (iTXt) chunks of a PNG, the image data chunks are copied untouched """
+    chunks: List[Tuple[bytes, bytes]] = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length = struct.unpack('>I', data[position:position + 4])[0]
+        chunks.append((data[position + 4:position + 8], data[position + 8:position + 8 + length]))
+        position += 12 + length
+
+    exif_index = next((i for i, (t, _) in enumerate(chunks) if t == b'eXIf'), None)
+    xmp_index = next((i for i, (t, p) in enumerate(chunks) if t == b'iTXt' and p.startswith(XMP_PNG_KEYWORD + b'\x00')), None)
+
+    xmp = None
+    if xmp_index is not None:
+        # keyword \0 compression flag, compression method, language tag \0 translated keyword \0 text
+        payload = chunks[xmp_index][1][len(XMP_PNG_KEYWORD) + 1:]
+        compressed = payload[0] == 1
+        text = payload[2:].split(b'\x00', 2)[2]
+        xmp = zlib.decompress(text) if compressed else text
+
+    exif = set_exif_description(chunks[exif_index][1] if exif_index is not None else None, gemini_response['description'])
+    itxt = XMP_PNG_KEYWORD + b'\x00\x00\x00\x00\x00' + merge_xmp_subjects(xmp, gemini_response['tags'])
+
+    for index, chunk_type, payload in ((exif_index, b'eXIf', exif), (xmp_index, b'iTXt', itxt)):
+        if index is None:
+            # Straight after IHDR, which keeps eXIf ahead of the image data as the spec requires
+            chunks.insert(1, (chunk_type, payload))
+        else:
+            chunks[index] = (chunk_type, payload)
+    return PNG_SIGNATURE + b''.join(_png_chunk(t, p) for t, p in chunks)
+
+
+def write_metadata_native(filepath: str, gemini_response: Dict[str, str]) -> bool:
+    """
+    Writes a gemini_response to a JPEG or PNG and renames it, the same as metadata_command does with exiftool.
+    The new file is written next to the original and moved into place, so a failure never leaves a partial file
+
+    Return
+    ------
+    bool
+        False if the file isn't a JPEG or PNG and has been left alone
+
+    Raises
+    ------
+    FileExistsError
+        If another file already has the new name
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'\xff\xd8'):
+        updated = update_jpeg(data, gemini_response)
+    elif data.startswith(PNG_SIGNATURE):
+        updated = update_png(data, gemini_response)
+    else:
+        return False
+
+    folder = os.path.split(filepath)[0]
+    new_filepath = folder + '/' + gemini_response['name']
+    # exiftool refuses to rename over an existing file, so don't either
+    if os.path.abspath(new_filepath) != os.path.abspath(filepath) and os.path.exists(new_filepath):
+        raise FileExistsError(f"'{new_filepath}' already exists")
+
+    fd, temp_path = tempfile.mkstemp(dir=folder or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(updated)
+        os.chmod(temp_path, os.stat(filepath).st_mode & 0o7777)
+        os.replace(temp_path, new_filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    if os.path.abspath(new_filepath) != os.path.abspath(filepath):
+        os.remove(filepath)
+    return True
+
+
+def save_metadata(updates: Sequence[Tuple[str, Dict[str, str]]]) -> List[Tuple[bool, str]]:
+    """
+    Writes gemini_responses to images and renames them, in Python where possible and with the shared
+    exiftool workers for the rest (HEIC, or files the native writer can't parse)
+
+    Parameters
+    ----------
+    updates : Sequence[Tuple[str, Dict[str, str]]]
+        The path of each image and the gemini_response to write to it
+
+    Return
+    ------
+    List[Tuple[bool, str]]
+        Whether each write succeeded and any error output, in order
+    """
+    results: List[Tuple[bool, str]] = [(False, '')] * len(updates)
+    fallback = []
+    for i, (filepath, gemini_response) in enumerate(updates):
+        if NATIVE_METADATA:
+            try:
+                if write_metadata_native(filepath, gemini_response):
+                    results[i] = (True, '')
+                    continue
+            except FileExistsError as e:
+                results[i] = (False, str(e))
+                continue
+            except Exception as e:
+                print(f"Native metadata write failed for {filepath}, using exiftool: {e}")
+        fallback.append(i)
+
+    if fallback:
+        try:
+            outputs = get_exiftool_pool().run([metadata_command(*updates[i]) for i in fallback])
+        except FileNotFoundError:
+            outputs = [(False, 'Error: ExifTool not found.')] * len(fallback)
+        for i, output in zip(fallback, outputs):
+            results[i] = output
+    return results
@@ -0,0 +1,387 @@
+from typing import Any, Awaitable, Callable, Dict, List, Set
+import asyncio
+import collections
+import importlib.util
+import os
+import httpx
+from listing import FolderListing
+
+
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+GRAPH_TIMEOUT = float(os.getenv('GRAPH_TIMEOUT', '30'))
+GRAPH_MAX_CONNECTIONS = int(os.getenv('GRAPH_MAX_CONNECTIONS', '100'))
+# Bytes read from OneDrive and written to the client at a time when passing a download through
+ONEDRIVE_DOWNLOAD_CHUNK_SIZE = int(os.getenv('ONEDRIVE_DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+# Graph accepts at most 20 requests in one $batch
+GRAPH_BATCH_LIMIT = 20
+# Children returned per page, Graph's default is 200
+ONEDRIVE_PAGE_SIZE = int(os.getenv('ONEDRIVE_PAGE_SIZE', '1000'))
+# $batch requests in flight at once for one crawl
+ONEDRIVE_CRAWL_CONCURRENCY = int(os.getenv('ONEDRIVE_CRAWL_CONCURRENCY', '4'))
+# Rounds of retries for throttled (429) or unavailable (503) requests
+ONEDRIVE_MAX_RETRIES = int(os.getenv('ONEDRIVE_MAX_RETRIES', '5'))
+ITEM_QUERY = "$select=id,name,size,webUrl,file,folder&$expand=thumbnails($select=large)"
+CHILDREN_QUERY = f"{ITEM_QUERY}&$top={ONEDRIVE_PAGE_SIZE}"
+# Delta can't expand thumbnails, changed images are fetched again with ITEM_QUERY
+DELTA_QUERY = "$select=id,name,file,folder,deleted,parentReference"
+# HTTP/2 needs the optional h2 package, without it the client falls back to HTTP/1.1 keep-alive
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+_graph_client: httpx.AsyncClient | None = None
+
+
+class GraphError(Exception):
+    """ A Microsoft Graph request failed, status_code is Graph's HTTP status """
+
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def get_graph_client() -> httpx.AsyncClient:
+    """
+    The application-wide client for Graph and OneDrive downloads, so connections are pooled and kept alive
+    between requests. Created on first use and closed by close_graph_client
+    """
+    global _graph_client
+    if _graph_client is None:
+        _graph_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(GRAPH_TIMEOUT),
+            limits=httpx.Limits(max_connections=GRAPH_MAX_CONNECTIONS, max_keepalive_connections=GRAPH_MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+    return _graph_client
+
+
+async def close_graph_client() -> None:
+    global _graph_client
+    if _graph_client is not None:
+        client, _graph_client = _graph_client, None
+        await client.aclose()
+
+
+async def graph_get(url: str, access_token: str, refresh: Callable[[], Awaitable[str]]) -> httpx.Response:
+    """
+    GETs a Graph URL, refreshing the access token and trying once more if it has expired
+
+    Parameters
+    ----------
+    url : str
+        A full Graph URL
+    access_token : str
+        The session's current access token
+    refresh : Callable[[], Awaitable[str]]
+        Refreshes the session's token and returns the new one
+
+    Return
+    ------
+    httpx.Response
+        Graph's response, its status may be an error
+    """
+    client = get_graph_client()
+    response = await client.get(url, headers={'Authorization': f'Bearer {access_token}'})
+    if response.status_code == 401:
+        # Token might be expired, try to refresh
+        access_token = await refresh()
+        response = await client.get(url, headers={'Authorization': f'Bearer {access_token}'})
+    return response
+
+
+async def get_item(item_id: str, access_token: str, refresh: Callable[[], Awaitable[str]]) -> dict:
+    """
+    The metadata of a drive item, including its pre-authenticated @microsoft.graph.downloadUrl
+
+    Raises
+    ------
+    GraphError
+        If Graph doesn't return the item
+    """
+    url = f"{GRAPH_URL}/me/drive/items/{item_id}?$select=id,name,size,file,@microsoft.graph.downloadUrl"
+    response = await graph_get(url, access_token, refresh)
+    if response.status_code != 200:
+        raise GraphError(response.status_code, f"Failed to get file metadata: {response.text}")
+    return response.json()
+
+
+async def open_download_stream(download_url: str, range_header: str | None = None) -> httpx.Response:
+    """
+    Starts downloading from a pre-authenticated downloadUrl without reading the body, so it can be passed on
+    to the client chunk by chunk in constant memory. The caller must aclose() the response
+
+    Parameters
+    ----------
+    download_url : str
+        The item's @microsoft.graph.downloadUrl, it needs no Authorization header
+    range_header : str | None
+        The client's Range header, passed on as is so OneDrive answers 206 with just those bytes
+    """
+    # Raw bytes are passed through, so ask for them unencoded to keep Content-Length and Content-Range exact
+    headers = {'Accept-Encoding': 'identity'}
+    if range_header:
+        headers['Range'] = range_header
+    client = get_graph_client()
+    return await client.send(client.build_request('GET', download_url, headers=headers), stream=True)
+
+
+def image_entry(item: Dict[str, Any]) -> Dict[str, Any]:
+    """ The fields the frontend uses for a OneDrive image """
+    return {
+        'id': item['id'],
+        'name': item['name'],
+        'mimeType': item.get('file', {}).get('mimeType', ''),
+        'url': item.get('webUrl'),
+        'thumbnailUrl': item.get('thumbnails', [{}])[0].get('large', {}).get('url') if item.get('thumbnails') else None,
+        'sizeBytes': item.get('size')
+    }
+
+
+def _children_url(folder_id: str) -> str:
+    return f"/me/drive/items/{folder_id}/children?{CHILDREN_QUERY}"
+
+
+def _retry_after(headers: Dict[str, str] | httpx.Headers) -> float:
+    # Header names are lower case on httpx responses but not inside $batch responses
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return float(value)
+            except ValueError:
+                break
+    return 1.0
+
+
+class _SharedToken:
+    """ A session's access token shared by concurrent requests, refreshed once however many of them hit a 401 """
+
+    def __init__(self, access_token: str, refresh: Callable[[], Awaitable[str]]) -> None:
+        self.value = access_token
+        self._refresh = refresh
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, expired: str) -> None:
+        async with self._lock:
+            # Another request may have refreshed it already
+            if self.value == expired:
+                self.value = await self._refresh()
+
+
+async def _get_json(url: str, token: _SharedToken) -> Dict[str, Any]:
+    """ GETs a full Graph URL, retrying expired tokens and throttling """
+    client = get_graph_client()
+    for _ in range(ONEDRIVE_MAX_RETRIES + 1):
+        sent_token = token.value
+        response = await client.get(url, headers={'Authorization': f'Bearer {sent_token}'})
+        if response.status_code == 401:
+            await token.refresh(sent_token)
+            continue
+        if response.status_code in (429, 503):
+            await asyncio.sleep(_retry_after(response.headers))
+            continue
+        if response.status_code != 200:
+            raise GraphError(response.status_code, f"Graph request failed: {response.text}")
+        return response.json()
+    raise GraphError(429, "Graph request failed: still throttled after retrying")
+
+
+async def _batch_get(urls: List[str], token: _SharedToken, missing_ok: bool = False) -> List[Dict[str, Any]]:
+    """
+    GETs up to GRAPH_BATCH_LIMIT URLs relative to GRAPH_URL in one $batch request, re-sending the ones
+    that were throttled, and returns the body of each in order. With missing_ok a 404 gives an empty body
+    """
+    client = get_graph_client()
+    bodies: Dict[int, Dict[str, Any]] = {}
+    pending = dict(enumerate(urls))
+    for _ in range(ONEDRIVE_MAX_RETRIES + 1):
+        sent_token = token.value
+        response = await client.post(
+            f"{GRAPH_URL}/$batch",
+            json={"requests": [{"id": str(i), "method": "GET", "url": url} for i, url in pending.items()]},
+            headers={'Authorization': f'Bearer {sent_token}'},
+        )
+        if response.status_code == 401:
+            await token.refresh(sent_token)
+            continue
+        if response.status_code in (429, 503):
+            await asyncio.sleep(_retry_after(response.headers))
+            continue
+        if response.status_code != 200:
+            raise GraphError(response.status_code, f"Graph request failed: {response.text}")
+
+        delay = 0.0
+        for result in response.json().get('responses', []):
+            i, status = int(result['id']), result.get('status')
+            if status == 200 or (status == 404 and missing_ok):
+                bodies[i] = result.get('body', {}) if status == 200 else {}
+                del pending[i]
+            elif status in (429, 503):
+                delay = max(delay, _retry_after(result.get('headers', {})))
+            elif status == 401:
+                await token.refresh(sent_token)
+            else:
+                raise GraphError(status, f"Graph request failed: {result.get('body')}")
+        if not pending:
+            return [bodies[i] for i in range(len(urls))]
+        await asyncio.sleep(delay)
+    raise GraphError(429, "Graph request failed: still throttled after retrying")
+
+
+async def crawl_folder_images(
+    folder_id: str,
+    access_token: str,
+    refresh: Callable[[], Awaitable[str]],
+    concurrency: int = ONEDRIVE_CRAWL_CONCURRENCY,
+    folders: Set[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Lists every image under a OneDrive folder, including subfolders. Pending folder listings and
+    follow-up pages (@odata.nextLink) are sent GRAPH_BATCH_LIMIT at a time in Graph $batch requests,
+    with up to concurrency batches in flight, so a large library takes a handful of round trips per level
+
+    Parameters
+    ----------
+    folder_id : str
+        The folder to start from
+    access_token : str
+        The session's current access token
+    refresh : Callable[[], Awaitable[str]]
+        Refreshes the session's token and returns the new one, called once however many batches hit a 401
+    concurrency : int
+        The most $batch requests in flight at once
+    folders : Set[str] | None
+        If given, the ids of folder_id and every subfolder are added to it
+
+    Return
+    ------
+    List[Dict[str, Any]]
+        An image_entry for every image found
+
+    Raises
+    ------
+    GraphError
+        If any listing fails for a reason other than throttling
+    """
+    token = _SharedToken(access_token, refresh)
+    if folders is not None:
+        folders.add(folder_id)
+    images = []
+    queued = collections.deque([_children_url(folder_id)])
+    tasks: set = set()
+    try:
+        while queued or tasks:
+            while queued and len(tasks) < concurrency:
+                urls = [queued.popleft() for _ in range(min(GRAPH_BATCH_LIMIT, len(queued)))]
+                tasks.add(asyncio.create_task(_batch_get(urls, token)))
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for page in task.result():
+                    for item in page.get('value', []):
+                        if 'folder' in item:
+                            if folders is not None:
+                                folders.add(item['id'])
+                            # Empty folders don't need listing
+                            if item['folder'].get('childCount', 1):
+                                queued.append(_children_url(item['id']))
+                        elif item.get('file', {}).get('mimeType', '').startswith('image/'):
+                            images.append(image_entry(item))
+                    next_link = page.get('@odata.nextLink')
+                    if next_link:
+                        # Batched URLs are relative to the API root
+                        queued.append(next_link.removeprefix(GRAPH_URL))
+    finally:
+        # One failed listing fails the whole crawl, so don't keep listing the rest
+        for task in tasks:
+            task.cancel()
+    return images
+
+
+async def list_folder(folder_id: str, access_token: str, refresh: Callable[[], Awaitable[str]]) -> FolderListing:
+    """ Lists a folder like crawl_folder_images, keeping what update_folder_listing needs to bring it up to date later """
+    # token=latest returns a delta link for now without enumerating the drive. Taken first, so anything
+    # changed while crawling is applied by the next update rather than missed
+    token = _SharedToken(access_token, refresh)
+    latest = await _get_json(f"{GRAPH_URL}/me/drive/root/delta?{DELTA_QUERY}&token=latest", token)
+    folders: Set[str] = set()
+    images = await crawl_folder_images(folder_id, token.value, refresh, folders=folders)
+    return FolderListing(folder_id, {image['id']: image for image in images}, folders, latest['@odata.deltaLink'])
+
+
+async def update_folder_listing(
+    listing: FolderListing,
+    access_token: str,
+    refresh: Callable[[], Awaitable[str]],
+) -> FolderListing | None:
+    """
+    Applies the changes made in the user's drive since listing was taken, from the drive's delta feed.
+    A folder nobody touched costs a single request, changed images are fetched again in $batch requests
+    for their thumbnails
+
+    Parameters
+    ----------
+    listing : FolderListing
+        A listing from list_folder or an earlier update, left unchanged
+    access_token : str
+        The session's current access token
+    refresh : Callable[[], Awaitable[str]]
+        Refreshes the session's token and returns the new one
+
+    Return
+    ------
+    FolderListing | None
+        The up to date listing, or None if folders were added to, moved in or removed from the tree or
+        Graph asks for a resync (410), in which case list the folder again
+    """
+    token = _SharedToken(access_token, refresh)
+    changes = []
+    url = listing.token
+    try:
+        while True:
+            page = await _get_json(url, token)
+            changes.extend(page.get('value', []))
+            if '@odata.deltaLink' in page:
+                break
+            url = page['@odata.nextLink']
+    except GraphError as e:
+        if e.status_code == 410:
+            return None
+        raise
+
+    images = dict(listing.images)
+    # Images to fetch again, in the order delta reported them, which may be more than once
+    changed: Dict[str, None] = {}
+    for item in changes:
+        item_id = item['id']
+        removed = 'deleted' in item
+        inside = item.get('parentReference', {}).get('id') in listing.folders
+        if 'folder' in item or item_id in listing.folders:
+            if item_id == listing.folder_id:
+                if removed:
+                    return None
+            elif item_id in listing.folders and (removed or not inside):
+                return None
+            elif item_id not in listing.folders and inside and not removed:
+                return None
+        elif not removed and inside and item.get('file', {}).get('mimeType', '').startswith('image/'):
+            changed[item_id] = None
+        else:
+            # Deleted or moved out of the tree
+            images.pop(item_id, None)
+            changed.pop(item_id, None)
+
+    changed_ids = list(changed)
+    chunks = [changed_ids[i:i + GRAPH_BATCH_LIMIT] for i in range(0, len(changed_ids), GRAPH_BATCH_LIMIT)]
+    for i in range(0, len(chunks), ONEDRIVE_CRAWL_CONCURRENCY):
+        group = chunks[i:i + ONEDRIVE_CRAWL_CONCURRENCY]
+        results = await asyncio.gather(*(
+            _batch_get([f"/me/drive/items/{item_id}?{ITEM_QUERY}" for item_id in chunk], token, missing_ok=True)
+            for chunk in group
+        ))
+        for chunk, bodies in zip(group, results):
+            for item_id, item in zip(chunk, bodies):
+                if item:
+                    images[item_id] = image_entry(item)
+                else:
+                    # Deleted since the delta was read
+                    images.pop(item_id, None)
+    return FolderListing(listing.folder_id, images, listing.folders, page['@odata.deltaLink'], listing.listed_at)
@@ -0,0 +1,82 @@
+from typing import Tuple
+import asyncio
+import os
+import tempfile
+from PIL import Image, ImageOps
+from hashing import get_hash_pool
+
+
+# The longest edge sent to Gemini, 0 uploads the original files untouched
+PREUPLOAD_MAX_EDGE = int(os.getenv('PREUPLOAD_MAX_EDGE', '1536'))
+PREUPLOAD_FORMAT = os.getenv('PREUPLOAD_FORMAT', 'JPEG').upper()
+PREUPLOAD_QUALITY = int(os.getenv('PREUPLOAD_QUALITY', '85'))
+PREUPLOAD_DIR = os.getenv('PREUPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'aegis_preupload'))
+
+_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def prepare_for_upload(
+    filepath: str,
+    max_edge: int = PREUPLOAD_MAX_EDGE,
+    fmt: str = PREUPLOAD_FORMAT,
+    quality: int = PREUPLOAD_QUALITY,
+) -> Tuple[str, int]:
+    """
+    Makes a downscaled, re-encoded copy of an image for sending to Gemini. The original is left untouched
+    so metadata can still be written to it.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the original image
+    max_edge : int
+        The longest edge of the copy in pixels, 0 disables preprocessing
+    fmt : str
+        'JPEG' or 'WEBP'
+    quality : int
+        The encoder quality of the copy
+
+    Return
+    ------
+    Tuple[str, int]
+        The path of the file to upload and its size in bytes. This is filepath itself when preprocessing
+        is disabled or wouldn't make the upload smaller
+    """
+    original_size = os.path.getsize(filepath)
+    if max_edge <= 0:
+        return filepath, original_size
+
+    with Image.open(filepath) as img:
+        if img.format == fmt and max(img.size) <= max_edge:
+            return filepath, original_size
+        # For JPEGs this lets the decoder skip straight to a reduced scale
+        img.draft('RGB', (max_edge, max_edge))
+        # EXIF is not copied, so bake the orientation into the pixels
+        reduced = ImageOps.exif_transpose(img).convert('RGB')
+    reduced.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    os.makedirs(PREUPLOAD_DIR, exist_ok=True)
+    fd, upload_path = tempfile.mkstemp(suffix=_EXTENSIONS.get(fmt, '.jpg'), dir=PREUPLOAD_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        reduced.save(f, format=fmt, quality=quality)
+
+    upload_size = os.path.getsize(upload_path)
+    if upload_size >= original_size:
+        os.remove(upload_path)
+        return filepath, original_size
+    return upload_path, upload_size
+
+
+async def prepare_for_upload_async(filepath: str) -> Tuple[str, int]:
+    """ Runs prepare_for_upload on the shared process pool """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_hash_pool(), prepare_for_upload, filepath)
+
+
+def discard_upload_copy(filepath: str, upload_path: str) -> None:
+    """ Removes the copy made by prepare_for_upload once it has been uploaded """
+    if upload_path != filepath:
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
@@ -0,0 +1,252 @@
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+import asyncio
+import concurrent.futures
+import os
+import random
+import re
+import threading
+import time
+from google.genai import errors
+import httpx
+
+
+GEMINI_REQUESTS_PER_SECOND = float(os.getenv('GEMINI_REQUESTS_PER_SECOND', '10'))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', '20'))
+GEMINI_MAX_IN_FLIGHT = int(os.getenv('GEMINI_MAX_IN_FLIGHT', '16'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '5'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '1'))
+GEMINI_BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', '60'))
+
+# How often a waiting coroutine re-checks for a free in-flight slot
+_SLOT_POLL_INTERVAL = 0.01
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """ Allows rate calls per second on average and up to burst at once. Safe to share between threads """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going into debt if there are none left
+
+        Return
+        ------
+        float
+            Seconds to wait before the call the token is for may start
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Rate limits (429), server errors (5xx) and dropped connections are worth retrying, other client errors aren't.
+    The genai client is built on httpx, so network failures arrive as httpx.TransportError (ConnectError,
+    ReadTimeout, RemoteProtocolError...) rather than the builtin ConnectionError
+    """
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def _retry_delay(error: BaseException) -> float | None:
+    """ The retryDelay Gemini suggests in the RetryInfo of a 429, e.g. '30s' """
+    details = getattr(error, 'details', None)
+    if not isinstance(details, dict):
+        return None
+    for detail in details.get('error', {}).get('details', []):
+        match = re.fullmatch(r'([\d.]+)s', str(detail.get('retryDelay', '')))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class GeminiScheduler:
+    """
+    Process-wide limits on calls to the Gemini API: a token bucket on requests per second, a cap on
+    requests in flight and retries with jittered exponential backoff on 429/5xx. Shared by sync threads
+    and async tasks, so every request in the process counts against the same quota
+    """
+
+    def __init__(
+        self,
+        rate: float = GEMINI_REQUESTS_PER_SECOND,
+        burst: int = GEMINI_BURST,
+        max_in_flight: int = GEMINI_MAX_IN_FLIGHT,
+        max_retries: int = GEMINI_MAX_RETRIES,
+        backoff_base: float = GEMINI_BACKOFF_BASE,
+        backoff_max: float = GEMINI_BACKOFF_MAX,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        rate : float
+            Requests started per second on average, 0 for no limit
+        burst : int
+            Requests that may start at once after a quiet period
+        max_in_flight : int
+            Requests running at the same time
+        max_retries : int
+            Retries of a request that failed with a retryable error
+        backoff_base : float
+            Seconds before the first retry, doubled for each one after it
+        backoff_max : float
+            The longest wait between retries
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self._stats: Dict[str, float] = {
+            "calls": 0, "retries": 0, "failures": 0, "throttled_seconds": 0.0, "peak_in_flight": 0,
+        }
+        # Uploads run here instead of a new pool per batch, sized so every in-flight slot can be used
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="gemini")
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        # Full jitter keeps clients that failed together from retrying together
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        suggested = _retry_delay(error)
+        return max(delay, suggested) if suggested is not None else delay
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _started(self) -> None:
+        with self._stats_lock:
+            self._in_flight += 1
+            self._stats["calls"] += 1
+            self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], self._in_flight)
+
+    def _finished(self) -> None:
+        with self._stats_lock:
+            self._in_flight -= 1
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """ Runs fn(*args, **kwargs) within the limits, retrying retryable errors """
+        attempt = 0
+        while True:
+            wait = self.bucket.reserve()
+            if wait:
+                self._count("throttled_seconds", wait)
+                time.sleep(wait)
+            with self._slots:
+                self._started()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e) or attempt == self.max_retries:
+                        self._count("failures")
+                        raise
+                    error = e
+                finally:
+                    self._finished()
+            delay = self._backoff(attempt, error)
+            print(f"Gemini request failed ({error}), retrying in {delay:.1f}s")
+            self._count("retries")
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """ Async version of call, for the client's aio interface. Waits without blocking the event loop """
+        attempt = 0
+        while True:
+            wait = self.bucket.reserve()
+            if wait:
+                self._count("throttled_seconds", wait)
+                await asyncio.sleep(wait)
+            # The slots are shared with threads, so poll rather than block the loop on the semaphore
+            while not self._slots.acquire(blocking=False):
+                await asyncio.sleep(_SLOT_POLL_INTERVAL)
+            self._started()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                error = e
+            finally:
+                self._finished()
+                self._slots.release()
+            delay = self._backoff(attempt, error)
+            print(f"Gemini request failed ({error}), retrying in {delay:.1f}s")
+            self._count("retries")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """ Counters since startup, e.g. how many calls were retried and how long calls waited for the rate limit """
+        with self._stats_lock:
+            return {**self._stats, "in_flight": self._in_flight}
+
+
+gemini_scheduler = GeminiScheduler()
+
+
+class _FakeQuotaClient:
+    """ Stands in for a Gemini endpoint that answers 429 above a rate or concurrency limit """
+
+    def __init__(self, rate: float, max_in_flight: int, latency: float) -> None:
+        self.bucket = TokenBucket(rate, max_in_flight)
+        self.latency = latency
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.rejected = 0
+
+    def request(self) -> str:
+        if self.bucket.reserve() > 0 or not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise errors.ClientError(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "quota"}})
+        try:
+            time.sleep(self.latency)
+            return "ok"
+        finally:
+            self.slots.release()
+
+
+def benchmark(requests: int = 200, quota_rate: float = 50, quota_in_flight: int = 8, latency: float = 0.05) -> None:
+    """ Fires requests at a fake quota-limited endpoint from a thread pool, with and without the scheduler """
+    def unscheduled(client: _FakeQuotaClient) -> bool:
+        try:
+            client.request()
+            return True
+        except errors.APIError:
+            return False
+
+    client = _FakeQuotaClient(quota_rate, quota_in_flight, latency)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as pool:
+        succeeded = sum(pool.map(lambda _: unscheduled(client), range(requests)))
+    print(f"no scheduler: {succeeded}/{requests} succeeded, {client.rejected} rejected, {time.perf_counter() - start:.2f}s")
+
+    client = _FakeQuotaClient(quota_rate, quota_in_flight, latency)
+    scheduler = GeminiScheduler(rate=quota_rate * 0.9, burst=quota_in_flight, max_in_flight=quota_in_flight, backoff_base=0.05)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as pool:
+        succeeded = sum(r == "ok" for r in pool.map(lambda _: scheduler.call(client.request), range(requests)))
+    print(f"scheduler:    {succeeded}/{requests} succeeded, {client.rejected} rejected, {time.perf_counter() - start:.2f}s, {scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    # python scheduler.py [requests]
+    import sys
+    benchmark(*(int(n) for n in sys.argv[1:2]))
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from grouping import GROUPING_BACKENDS, HASH_BITS, MultiIndexHash, _group_pairwise, group_similar
+
+
+def near_duplicate_hashes(size: int, seed: int = 0) -> list:
+    """ Bursts of hashes a few bits apart, like shots of the same scene """
+    rng = random.Random(seed)
+    hashes = []
+    while len(hashes) < size:
+        scene = rng.getrandbits(HASH_BITS)
+        for _ in range(rng.randint(1, 5)):
+            shot = scene
+            for _ in range(rng.randint(0, 12)):
+                shot ^= 1 << rng.randrange(HASH_BITS)
+            hashes.append(shot)
+    return hashes[:size]
+
+
+def normalise(groups):
+    return sorted(sorted(group) for group in groups)
+
+
+@pytest.mark.parametrize("backend", GROUPING_BACKENDS)
+@pytest.mark.parametrize("threshold", [0, 3, 6, 10, 20])
+def test_backends_match_pairwise(backend, threshold):
+    hashes = near_duplicate_hashes(400)
+    assert normalise(group_similar(hashes, threshold, backend=backend)) == normalise(_group_pairwise(hashes, threshold))
+
+
+@pytest.mark.parametrize("backend", GROUPING_BACKENDS)
+def test_exact_threshold_is_inclusive(backend):
+    base = 0
+    hashes = [base, base ^ 0b111, base ^ (0b111 << 40) ^ 0b1111]
+    assert normalise(group_similar(hashes, 3, backend=backend)) == [[0, 1]]
+
+
+@pytest.mark.parametrize("backend", GROUPING_BACKENDS)
+def test_empty_and_single(backend):
+    assert group_similar([], 20, backend=backend) == []
+    assert group_similar([123], 20, backend=backend) == []
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        group_similar([1, 2], 3, backend="nope")
+
+
+def test_default_backend_is_numpy(monkeypatch):
+    import grouping
+    called = []
+    monkeypatch.setattr(grouping, "_group_numpy", lambda hashes, threshold: called.append(threshold) or [])
+    group_similar([1, 2], 20)
+    assert called == [20]
+
+
+def test_mih_chunking_prunes_at_tight_thresholds():
+    # Radius 0 or 1 per chunk when the threshold is tight, so each query probes few buckets
+    index = MultiIndexHash.for_threshold(6, 10_000)
+    assert 6 // index.chunks <= 1
+    # Never more than one chunk per bit
+    assert 1 <= MultiIndexHash.for_threshold(20, 10).chunks <= HASH_BITS
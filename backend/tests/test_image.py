@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+import threading
+
+import pytest
+from PIL import Image
+
+from image import DataLoader, ImageContainer, ImageProcessor, fan_out_response, iterate_in_thread, uniquify_filename
+
+
+def collect(iterable, **kwargs):
+    async def run():
+        return [item async for item in iterate_in_thread(iterable, **kwargs)]
+    return asyncio.run(run())
+
+
+def test_iterate_in_thread_keeps_order():
+    assert collect(range(100)) == list(range(100))
+    assert collect([]) == []
+
+
+def test_iterate_in_thread_raises_producer_errors():
+    def failing():
+        yield 1
+        raise OSError("disk gone")
+
+    with pytest.raises(OSError, match="disk gone"):
+        collect(failing())
+
+
+def test_iterate_in_thread_runs_at_most_maxsize_ahead():
+    produced = []
+
+    def counting():
+        for i in range(50):
+            produced.append(threading.current_thread().name)
+            yield i
+
+    async def run():
+        ahead = []
+        async for i in iterate_in_thread(counting(), maxsize=2):
+            await asyncio.sleep(0.01)
+            ahead.append(len(produced) - (i + 1))
+        return ahead
+
+    ahead = asyncio.run(run())
+    # The items in the queue, plus the one the producer holds while it waits for a slot
+    assert max(ahead) <= 3
+    assert threading.main_thread().name not in produced
+
+
+def test_iterate_in_thread_stops_producer_when_consumer_stops():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    async def run():
+        async with contextlib.aclosing(iterate_in_thread(endless())) as items:
+            async for i in items:
+                if i == 3:
+                    break
+
+    asyncio.run(run())
+    assert closed.wait(timeout=5)
+
+
+def test_batches_start_before_the_scan_finishes(tmp_path, monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"x")
+    processor = ImageProcessor()
+    scanned = []
+    scanned_at_first_batch = []
+
+    def scan():
+        for i in range(400):
+            scanned.append(i)
+            yield ImageContainer(filepath=str(path), img=None, exif_dict={}, size=(100, 100))
+
+    async def inference(batch, on_progress=None):
+        if not scanned_at_first_batch:
+            scanned_at_first_batch.append(len(scanned))
+        await asyncio.sleep(0.01)
+        return batch
+
+    monkeypatch.setattr(processor, "gemini_inference_async", inference)
+
+    async def run():
+        return [result async for _, result in processor.gemini_inference_batched_async(scan(), max_concurrent=1)]
+
+    results = asyncio.run(run())
+    assert sum(len(batch) for batch in results) == 400
+    assert scanned_at_first_batch[0] < 400
+
+
+def test_scan_reads_only_the_given_paths(tmp_path):
+    saved = []
+    for i in range(3):
+        path = tmp_path / f"{i}.jpg"
+        Image.new("RGB", (40, 30)).save(path)
+        saved.append(str(path))
+    # Left behind by a download that failed, it must not be read at all
+    (tmp_path / "partial.jpg").write_bytes(b"\xff\xd8\xff")
+    loader = DataLoader(folder_path=str(tmp_path), objs=None)
+    images = list(loader.iter_images_from_folder_path(paths=saved + [str(tmp_path / "notes.txt")]))
+    assert sorted(img.filepath for img in images) == saved
+    assert loader.errors == []
+
+
+def container(filepath: str, response: dict | None = None) -> ImageContainer:
+    return ImageContainer(filepath=filepath, img=None, exif_dict={}, gemini_response=response or {})
+
+
+def test_uniquify_filename():
+    taken = set()
+    assert uniquify_filename("beach.jpg", taken) == "beach.jpg"
+    assert uniquify_filename("beach.jpg", taken) == "beach_2.jpg"
+    assert uniquify_filename("beach.jpg", taken, ".heic") == "beach.heic"
+    assert uniquify_filename("beach.jpg", taken, ".heic") == "beach_2.heic"
+    assert uniquify_filename("beach_2.jpg", taken) == "beach_2_2.jpg"
+    assert taken == {"beach.jpg", "beach_2.jpg", "beach.heic", "beach_2.heic", "beach_2_2.jpg"}
+
+
+def test_fan_out_response_gives_every_member_a_unique_name():
+    response = {"name": "beach.jpg", "tags": ["sea"], "description": "A beach"}
+    representative = container("a/1.jpg", response)
+    members = [container("a/2.jpg"), container("a/3.HEIC"), container("a/4.jpg")]
+    taken = set()
+    fan_out_response(representative, members, taken)
+    names = [img.gemini_response["name"] for img in [representative, *members]]
+    assert names == ["beach.jpg", "beach_2.jpg", "beach.heic", "beach_3.jpg"]
+    assert all(img.gemini_response["tags"] == ["sea"] for img in members)
+    # The representative's response is copied, not shared
+    assert response["name"] == "beach.jpg" and members[0].gemini_response is not representative.gemini_response
+
+
+def test_fan_out_response_renames_representatives_across_clusters():
+    taken = set()
+    first = container("a/1.jpg", {"name": "beach.jpg"})
+    second = container("a/2.jpg", {"name": "beach.jpg"})
+    fan_out_response(first, [], taken)
+    fan_out_response(second, [container("a/3.jpg")], taken)
+    assert first.gemini_response["name"] == "beach.jpg"
+    assert second.gemini_response["name"] == "beach_2.jpg"
+    assert taken == {"beach.jpg", "beach_2.jpg", "beach_3.jpg"}
+
+
+def test_fan_out_response_skips_failed_results():
+    member = container("a/2.jpg")
+    taken = set()
+    fan_out_response(container("a/1.jpg"), [member], taken)
+    assert member.gemini_response == {} and taken == set()
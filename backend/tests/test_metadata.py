@@ -0,0 +1,208 @@
+import io
+import struct
+import sys
+import textwrap
+from xml.etree import ElementTree
+
+import pytest
+from PIL import Image, IptcImagePlugin
+
+from metadata import (
+    IPTC_KEYWORDS, TIFF_ASCII, ExifToolPool, _read_iptc, _write_iptc, add_iptc_keywords, update_jpeg,
+    write_metadata_native,
+)
+
+
+# Speaks exiftool's -stay_open protocol. Dies on any file named like 'crash*', once if CRASH_ONCE names a marker file
+FAKE_EXIFTOOL = textwrap.dedent('''\
+    import os, sys
+    args = []
+    for line in sys.stdin:
+        line = line.rstrip('\\n')
+        if line.startswith('-execute'):
+            path = args[-1]
+            if os.path.basename(path).startswith('crash'):
+                marker = os.environ.get('CRASH_ONCE')
+                if not marker or not os.path.exists(marker):
+                    if marker:
+                        open(marker, 'w').close()
+                    sys.exit(1)
+            if os.path.exists(path):
+                print('    1 image files updated')
+            else:
+                print(f'Error: File not found - {path}')
+                print('    0 image files updated')
+            print('{ready%s}' % line[len('-execute'):], flush=True)
+            args = []
+        elif args[-1:] == ['-stay_open'] and line == 'False':
+            break
+        else:
+            args.append(line)
+''')
+
+
+@pytest.fixture
+def fake_exiftool(tmp_path):
+    script = tmp_path / 'fake_exiftool.py'
+    script.write_text(FAKE_EXIFTOOL)
+    executable = tmp_path / 'exiftool'
+    executable.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+    executable.chmod(0o755)
+    return str(executable)
+
+
+def make_files(directory, names):
+    paths = []
+    for name in names:
+        path = directory / name
+        path.write_bytes(b'')
+        paths.append(str(path))
+    return paths
+
+
+def run(executable, paths):
+    pool = ExifToolPool(size=1, executable=executable)
+    try:
+        return pool.run([['-Description=x', path] for path in paths])
+    finally:
+        pool.close()
+
+
+def test_all_commands_succeed(fake_exiftool, tmp_path):
+    results = run(fake_exiftool, make_files(tmp_path, ['a.jpg', 'b.jpg', 'c.jpg']))
+    assert [ok for ok, _ in results] == [True, True, True]
+
+
+def test_failed_command_is_reported(fake_exiftool, tmp_path):
+    paths = make_files(tmp_path, ['a.jpg'])
+    results = run(fake_exiftool, paths + [str(tmp_path / 'missing.jpg')])
+    assert [ok for ok, _ in results] == [True, False]
+    assert 'File not found' in results[1][1]
+
+
+@pytest.mark.parametrize('crash_once', [True, False])
+def test_crash_fails_only_the_poison_command(fake_exiftool, tmp_path, monkeypatch, crash_once):
+    if crash_once:
+        monkeypatch.setenv('CRASH_ONCE', str(tmp_path / 'crashed'))
+    paths = make_files(tmp_path, ['a.jpg', 'crash.jpg', 'b.jpg', 'c.jpg', 'd.jpg'])
+    results = run(fake_exiftool, paths)
+    assert [ok for ok, _ in results] == [True, False, True, True, True]
+    assert 'exiftool exited' in results[1][1]
+
+
+def test_several_crashes_in_one_chunk(fake_exiftool, tmp_path):
+    paths = make_files(tmp_path, ['crash1.jpg', 'a.jpg', 'crash2.jpg', 'crash3.jpg', 'b.jpg'])
+    results = run(fake_exiftool, paths)
+    assert [ok for ok, _ in results] == [False, True, False, False, True]
+
+
+RESPONSE = {'name': 'beach_sunset.jpg', 'tags': ['beach', 'sunset', 'café'], 'description': 'A sunset over the sea'}
+
+
+def jpeg(**save_args) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'orange').save(buffer, 'JPEG', **save_args)
+    return buffer.getvalue()
+
+
+def png(**save_args) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'orange').save(buffer, 'PNG', **save_args)
+    return buffer.getvalue()
+
+
+def iptc_keywords(img: Image.Image) -> list:
+    keywords = (IptcImagePlugin.getiptcinfo(img) or {}).get(IPTC_KEYWORDS, [])
+    return [k.decode('utf-8') for k in ([keywords] if isinstance(keywords, bytes) else keywords)]
+
+
+def xmp_subjects(xmp: bytes | str) -> list:
+    xmp = xmp.encode('utf-8') if isinstance(xmp, str) else xmp
+    body = xmp[xmp.index(b'<x:xmpmeta'):xmp.index(b'</x:xmpmeta>') + len(b'</x:xmpmeta>')]
+    bag = './/{http://purl.org/dc/elements/1.1/}subject/{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Bag'
+    return [li.text for li in ElementTree.fromstring(body).find(bag)]
+
+
+@pytest.mark.parametrize('make', [jpeg, png])
+def test_native_writer_round_trip(tmp_path, make):
+    original = tmp_path / ('photo.jpg' if make is jpeg else 'photo.png')
+    original.write_bytes(make())
+    response = {**RESPONSE, 'name': 'beach_sunset' + original.suffix}
+    assert write_metadata_native(str(original), response)
+
+    renamed = tmp_path / response['name']
+    assert not original.exists()
+    with Image.open(renamed) as img:
+        img.load()
+        assert img.size == (8, 8)
+        assert img.getexif()[0x010E] == 'A sunset over the sea'
+        assert xmp_subjects(img.info['xmp'] if make is jpeg else img.info['XML:com.adobe.xmp']) == RESPONSE['tags']
+        if make is jpeg:
+            assert iptc_keywords(img) == RESPONSE['tags']
+
+
+def test_native_writer_merges_with_existing_metadata(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    path.write_bytes(jpeg())
+    write_metadata_native(str(path), {**RESPONSE, 'name': 'photo.jpg'})
+    # Writing again replaces the description and doesn't repeat keywords
+    write_metadata_native(str(path), {'name': 'photo.jpg', 'tags': ['sea', 'beach'], 'description': 'Later'})
+    with Image.open(path) as img:
+        assert img.getexif()[0x010E] == 'Later'
+        assert xmp_subjects(img.info['xmp']) == ['beach', 'sunset', 'café', 'sea']
+        assert iptc_keywords(img) == ['beach', 'sunset', 'café', 'sea']
+
+
+def test_native_writer_refuses_to_overwrite(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    path.write_bytes(jpeg())
+    (tmp_path / RESPONSE['name']).write_bytes(b'someone else')
+    with pytest.raises(FileExistsError):
+        write_metadata_native(str(path), RESPONSE)
+    assert path.exists()
+
+
+def test_native_writer_skips_other_formats(tmp_path):
+    path = tmp_path / 'photo.heic'
+    path.write_bytes(b'\x00\x00\x00\x18ftypheic')
+    assert not write_metadata_native(str(path), RESPONSE)
+    assert path.exists()
+
+
+def test_exif_update_keeps_unknown_tags_and_maker_notes():
+    # Big-endian like Canon, with CompositeImage (0xA460) in the Exif IFD and a MakerNote holding an absolute offset
+    maker_note = b'MAKER' + struct.pack('>I', 0x1234)
+    exif_ifd = 8 + 2 + 2 * 12 + 4
+    maker_offset = exif_ifd + 2 + 2 * 12 + 4
+    tiff = (
+        b'MM\x00*' + struct.pack('>I', 8)
+        # IFD0: Model and the Exif IFD pointer
+        + struct.pack('>H', 2)
+        + struct.pack('>HHI4s', 0x0110, TIFF_ASCII, 4, b'Cam\x00')
+        + struct.pack('>HHII', 0x8769, 4, 1, exif_ifd)
+        + struct.pack('>I', 0)
+        # Exif IFD: MakerNote and CompositeImage = 2
+        + struct.pack('>H', 2)
+        + struct.pack('>HHII', 0x927C, 7, len(maker_note), maker_offset)
+        + struct.pack('>HHIHH', 0xA460, 3, 1, 2, 0)
+        + struct.pack('>I', 0)
+        + maker_note
+    )
+    updated = jpeg(exif=b'Exif\x00\x00' + tiff)
+    for _ in range(2):
+        # The second pass replaces the ImageDescription the first one added
+        updated = update_jpeg(updated, {**RESPONSE, 'description': 'A long description'})
+
+    exif = Image.open(io.BytesIO(updated)).getexif()
+    assert exif[0x010E] == 'A long description'
+    assert exif[0x0110] == 'Cam'
+    assert exif.get_ifd(0x8769)[0xA460] == 2
+    new_tiff = updated[updated.index(b'Exif\x00\x00') + 6:]
+    assert new_tiff[maker_offset:maker_offset + len(maker_note)] == maker_note
+
+
+def test_iptc_keywords_are_transcoded_to_utf8():
+    # An IPTC block without a character set holding a Latin-1 keyword
+    iptc = add_iptc_keywords(_write_iptc([(2, 0, b'\x00\x04'), (*IPTC_KEYWORDS, b'caf\xe9')]), ['plage'])
+    keywords = [value.decode('utf-8') for record, dataset, value in _read_iptc(iptc) if (record, dataset) == IPTC_KEYWORDS]
+    assert keywords == ['café', 'plage']
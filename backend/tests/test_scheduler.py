@@ -0,0 +1,81 @@
+import asyncio
+
+import httpx
+import pytest
+from google.genai import errors
+
+from scheduler import GeminiScheduler, is_retryable
+
+
+def api_error(code: int) -> errors.APIError:
+    return errors.APIError(code, {"error": {"code": code, "message": "error"}})
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (api_error(429), True),
+    (api_error(500), True),
+    (api_error(503), True),
+    (api_error(400), False),
+    (api_error(404), False),
+    (httpx.ConnectError("connection refused"), True),
+    (httpx.ReadTimeout("timed out"), True),
+    (httpx.RemoteProtocolError("server disconnected"), True),
+    (ConnectionResetError(), True),
+    (TimeoutError(), True),
+    (ValueError("bad response"), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) is retryable
+
+
+class FlakyClient:
+    """ Fails the first few requests the way the genai client does when the network drops """
+
+    def __init__(self, failures: int, error: Exception) -> None:
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def request(self) -> str:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "ok"
+
+    async def request_async(self) -> str:
+        return self.request()
+
+
+def scheduler() -> GeminiScheduler:
+    return GeminiScheduler(rate=0, backoff_base=0, max_retries=3)
+
+
+def test_call_retries_connect_error():
+    client = FlakyClient(2, httpx.ConnectError("connection refused"))
+    gemini = scheduler()
+    assert gemini.call(client.request) == "ok"
+    assert client.calls == 3
+    assert gemini.stats()["retries"] == 2
+
+
+def test_call_async_retries_connect_error():
+    client = FlakyClient(2, httpx.ConnectError("connection refused"))
+    gemini = scheduler()
+    assert asyncio.run(gemini.call_async(client.request_async)) == "ok"
+    assert client.calls == 3
+
+
+def test_call_gives_up_after_max_retries():
+    client = FlakyClient(10, httpx.ConnectError("connection refused"))
+    gemini = scheduler()
+    with pytest.raises(httpx.ConnectError):
+        gemini.call(client.request)
+    assert client.calls == 4
+    assert gemini.stats()["failures"] == 1
+
+
+def test_call_does_not_retry_client_errors():
+    client = FlakyClient(1, api_error(400))
+    with pytest.raises(errors.APIError):
+        scheduler().call(client.request)
+    assert client.calls == 1
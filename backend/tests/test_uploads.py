@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+import pytest
+
+from cache import content_digest
+from uploads import UPLOAD_CHUNK_SIZE, ByteBudget, save_stream
+
+
+class BrokenStream(httpx.AsyncByteStream):
+    """ A response body that sends some bytes and then loses the connection """
+
+    async def __aiter__(self):
+        yield b"x" * 1000
+        raise httpx.ReadError("connection reset")
+
+
+class SlowStream(httpx.AsyncByteStream):
+    """ A response body that never finishes """
+
+    async def __aiter__(self):
+        yield b"x" * 1000
+        await asyncio.sleep(3600)
+
+
+def download(body: httpx.AsyncByteStream | bytes, destination, budget: ByteBudget):
+    """ Streams a mocked response into destination with save_stream """
+    def respond(request):
+        if isinstance(body, bytes):
+            return httpx.Response(200, content=body)
+        return httpx.Response(200, stream=body)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(respond)) as client:
+            response = await client.send(client.build_request("GET", "https://files.test/a.jpg"), stream=True)
+            try:
+                return await save_stream(response, destination, budget)
+            finally:
+                await response.aclose()
+
+    return run()
+
+
+def test_save_stream_writes_file(tmp_path):
+    data = bytes(range(256)) * (UPLOAD_CHUNK_SIZE // 100)
+    destination = tmp_path / "a.jpg"
+    digest, size = asyncio.run(download(data, destination, ByteBudget(UPLOAD_CHUNK_SIZE)))
+    assert destination.read_bytes() == data
+    assert (digest, size) == (content_digest(data), len(data))
+
+
+def test_failed_download_leaves_no_file(tmp_path):
+    destination = tmp_path / "a.jpg"
+    budget = ByteBudget(UPLOAD_CHUNK_SIZE)
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(download(BrokenStream(), destination, budget))
+    assert not destination.exists()
+    assert budget.in_flight == 0
+
+
+def test_cancelled_download_leaves_no_file(tmp_path):
+    destination = tmp_path / "a.jpg"
+    budget = ByteBudget(UPLOAD_CHUNK_SIZE)
+
+    async def run():
+        task = asyncio.create_task(download(SlowStream(), destination, budget))
+        while not destination.exists():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert not destination.exists()
+    assert budget.in_flight == 0
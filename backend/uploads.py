@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Awaitable, Callable, Tuple
+import asyncio
+import hashlib
+import os
+import httpx
+from fastapi import UploadFile
+
+
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+MAX_INFLIGHT_UPLOAD_BYTES = int(os.getenv('MAX_INFLIGHT_UPLOAD_BYTES', str(64 * 1024 * 1024)))
+
+
+class ByteBudget:
+    """ An async semaphore counted in bytes, shared by every request that buffers upload data """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> None:
+        # A single chunk larger than the whole budget is still let through on its own
+        size = min(size, self.capacity)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight + size <= self.capacity)
+            self.in_flight += size
+
+    async def release(self, size: int) -> None:
+        size = min(size, self.capacity)
+        async with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+
+upload_budget = ByteBudget(MAX_INFLIGHT_UPLOAD_BYTES)
+
+
+async def save_upload(file: UploadFile, destination: Path, budget: ByteBudget = upload_budget) -> Tuple[str, int]:
+    """
+    Copies an upload to disk in chunks, hashing it on the way, so at most one chunk per copy is held in memory.
+    If the copy fails or is cancelled the partial file is removed
+
+    Parameters
+    ----------
+    file : UploadFile
+        The uploaded file to save
+    destination : Path
+        Where to write the file
+    budget : ByteBudget
+        The shared limit on bytes buffered in memory across all concurrent copies
+
+    Return
+    ------
+    Tuple[str, int]
+        The content digest of the file (see cache.content_digest) and its size in bytes
+    """
+    return await _copy_chunks(lambda: file.read(UPLOAD_CHUNK_SIZE), destination, budget)
+
+
+async def save_stream(response: httpx.Response, destination: Path, budget: ByteBudget = upload_budget) -> Tuple[str, int]:
+    """
+    Copies the body of a streamed download to disk like save_upload, so files imported from the cloud
+    count against the same memory budget as uploads. The caller still has to aclose() the response
+
+    Parameters
+    ----------
+    response : httpx.Response
+        A response opened with stream=True whose body hasn't been read
+    destination : Path
+        Where to write the file
+    budget : ByteBudget
+        The shared limit on bytes buffered in memory across all concurrent copies
+
+    Return
+    ------
+    Tuple[str, int]
+        The content digest of the file (see cache.content_digest) and its size in bytes
+    """
+    chunks = response.aiter_bytes(UPLOAD_CHUNK_SIZE)
+    return await _copy_chunks(lambda: anext(chunks, b''), destination, budget)
+
+
+async def _copy_chunks(read: Callable[[], Awaitable[bytes]], destination: Path, budget: ByteBudget) -> Tuple[str, int]:
+    """
+    Writes what read returns to destination until it returns nothing, holding budget for each chunk.
+    Removes destination again if anything goes wrong, so a failed copy never leaves a truncated file behind
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    try:
+        with open(destination, "wb") as buffer:
+            while True:
+                await budget.acquire(UPLOAD_CHUNK_SIZE)
+                try:
+                    chunk = await read()
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    # Disk writes happen off the event loop
+                    await asyncio.to_thread(buffer.write, chunk)
+                finally:
+                    await budget.release(UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        # Cancellation too, e.g. the client went away mid-download
+        destination.unlink(missing_ok=True)
+        raise
+    return digest.hexdigest(), size
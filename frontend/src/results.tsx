@@ -9,7 +9,10 @@ interface GeminiResult {
 }
 
 interface StreamEvent {
-  status: 'uploading' | 'processing' | 'result' | 'complete' | 'error';
+  status: 'uploading' | 'processing' | 'stage' | 'result' | 'complete' | 'error';
+  // The stage an image just completed, e.g. 'saved' while uploading or 'read', 'uploaded', 'inferred' on 'stage' events
+  stage?: string;
+  file?: string;
   message?: string;
   progress?: number;
   total?: number;
@@ -250,7 +253,13 @@ export default function ResultsPage() {
 
       case 'processing':
         setProcessingStatus(event.message || 'Processing images...');
-        setUploadProgress(40); // 40% when processing starts
+        // 40% when processing starts, later messages (e.g. a failed batch) don't move the bar back
+        setUploadProgress((prev) => Math.max(prev, 40));
+        break;
+
+      case 'stage':
+        // Per-image progress through the pipeline, the bar itself follows the results
+        setProcessingStatus(event.message || `${event.stage} ${event.file}`);
         break;
 
       case 'result':